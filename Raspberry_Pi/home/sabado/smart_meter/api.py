@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
+import base64
+import functools
+import hashlib
+import json
 import logging
 import subprocess
 import os
-from database import Database
-from datetime import datetime, timedelta, timezone
+import time
+from database import Database, utc_now, TIMESTAMP_FORMAT, ROLLUP_RESOLUTIONS, AGGREGATE_BUCKETS
+from retention import ReadingArchive
+from control import send_command
+from power_series import PowerSeriesStore
+from response_cache import ResponseCache
+from live_feed import LiveFeed, EVENT_TYPES
+from instrumentation import REGISTRY, counter, gauge, histogram, render, with_labels
+from datetime import datetime, timedelta
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for Android app
@@ -15,11 +26,91 @@ CORS(app)  # Enable CORS for Android app
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("scheduler-api")
 
-# Initialize database
-db = Database(f"{os.getenv('HOME')}/smart_meter/scheduler.db")
+# Initialize database. Under gunicorn the master runs init_database once
+# before forking (gunicorn.conf.py) and each worker opens its own pool.
+DB_PATH = f"{os.getenv('HOME')}/smart_meter/scheduler.db"
+db = Database(DB_PATH,
+              readers=int(os.getenv('SMART_METER_DB_READERS', '4')),
+              init=os.getenv('SMART_METER_DB_INITIALIZED') != '1')
+
+# Packed voltage/current/power samples written by the scheduler
+power_series = PowerSeriesStore(db)
+
+# Raw readings moved out of the database by the scheduler's retention job
+archive = ReadingArchive(f"{os.getenv('HOME')}/smart_meter/archive")
+
+# Shared MQTT subscription for /api/live, connected on first use. Under
+# gunicorn each stream holds a request thread, so the cap is set below the
+# worker's thread count (see gunicorn.conf.py)
+live_feed = LiveFeed(broker='localhost', port=1883,
+                     max_subscribers=int(os.getenv('SMART_METER_LIVE_CLIENTS', '50')))
+
+# Rendered GET responses, validated against data_versions (see cached)
+response_cache = ResponseCache(ttl=5.0)
+
+API_REQUEST_SECONDS = histogram('smart_meter_api_request_seconds',
+                                'Time to produce a response (headers, for streams)',
+                                ['route', 'method', 'status'])
+API_CACHE_LOOKUPS = counter('smart_meter_api_cache_lookups_total', 'Response cache lookups', ['result'])
+API_CACHE_LOOKUPS.set_function(lambda: response_cache.hits, result='hit')
+API_CACHE_LOOKUPS.set_function(lambda: response_cache.misses, result='miss')
+LIVE_SUBSCRIBERS = gauge('smart_meter_live_subscribers', 'Connected /api/live clients')
+LIVE_SUBSCRIBERS.set_function(lambda: live_feed.subscriber_count())
+SCHEDULER_UP = gauge('smart_meter_scheduler_up', 'Whether /metrics could read the scheduler\'s metrics')
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        # Label by route pattern, not path, to keep one series per endpoint
+        API_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                    route=request.url_rule.rule if request.url_rule else 'unmatched',
+                                    method=request.method, status=response.status_code)
+    return response
+
+def cached(*scopes):
+    """
+    Cache a GET endpoint's 200 responses per path + query string and
+    answer If-None-Match with 304. scopes name the data_versions counters
+    the response depends on and may use the view's URL arguments, e.g.
+    'readings:{client_id}'. Streamed responses pass through untouched.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            # Read versions before rendering: a write that lands while the
+            # response is built leaves the entry stale, never wrongly fresh
+            versions = db.get_versions([scope.format(**kwargs) for scope in scopes])
+            key = request.path + '?' + '&'.join(
+                f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+
+            entry = response_cache.get(key, versions)
+            if entry is None:
+                response = app.make_response(view(**kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                entry = (hashlib.sha1(body).hexdigest(), body, response.mimetype)
+                response_cache.put(key, versions, *entry)
+
+            etag, body, mimetype = entry
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+            # Clients may keep the body but must revalidate before using it
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
 
 def restart_scheduler():
-    """Restart the scheduler service to reload jobs"""
+    """Restart the scheduler service to reload all jobs (fallback for update_scheduler)"""
     try:
         result = subprocess.run(
             ['sudo', 'systemctl', 'restart', 'smart-meter-scheduler.service'],
@@ -37,10 +128,40 @@ def restart_scheduler():
         log.error(f"Error during scheduler restart: {e}")
         return False
 
+def update_scheduler(action, schedule_id):
+    """
+    Apply a schedule change to the running scheduler through its control
+    socket (reload_schedule / remove_schedule). Falls back to restarting
+    the service if the scheduler can't be reached.
+    """
+    try:
+        response = send_command(action, schedule_id=schedule_id)
+    except Exception as e:
+        log.warning(f"Scheduler control socket unavailable ({e}), restarting service instead")
+        return restart_scheduler()
+
+    if not response.get('success'):
+        log.error(f"Scheduler rejected {action} for schedule {schedule_id}: {response.get('error')}")
+        return False
+
+    log.info(f"Scheduler applied {action} for schedule {schedule_id}")
+    return True
+
+def notify_threshold_change(client_id):
+    """
+    Tell the scheduler to refresh a device's threshold. Best effort: if
+    the scheduler is unreachable its periodic sweep picks the change up.
+    """
+    try:
+        send_command('reload_threshold', client_id=client_id)
+    except Exception as e:
+        log.warning(f"Could not notify scheduler of threshold change for {client_id}: {e}")
+
 
 # ============= SCHEDULES ENDPOINTS =============
 
 @app.route('/api/schedules', methods=['GET'])
+@cached('schedules')
 def get_all_schedules():
     """Get all schedules for all devices"""
     try:
@@ -58,15 +179,14 @@ def get_all_schedules():
 
 
 @app.route('/api/schedules/<client_id>', methods=['GET'])
+@cached('schedules:{client_id}')
 def get_device_schedules(client_id):
     """Get all schedules for a specific device"""
     try:
-        schedules = db.get_all_schedules()
-        device_schedules = [s for s in schedules if s['client_id'] == client_id]
         return jsonify({
             'success': True,
             'client_id': client_id,
-            'schedules': device_schedules
+            'schedules': db.get_schedules_for_device(client_id)
         }), 200
     except Exception as e:
         log.error(f"Error getting schedules for {client_id}: {e}")
@@ -155,14 +275,14 @@ def create_schedule():
         )
 
         log.info(f"Created schedule {schedule_id} for {client_id}")
-        restart_success = restart_scheduler()
+        scheduler_updated = update_scheduler('reload_schedule', schedule_id)
 
         return jsonify({
             'success': True,
             'schedule_id': schedule_id,
-            'scheduler_restarted': restart_success,
-            'message': 'Schedule created and scheduler restarted successfully!' if restart_success 
-                    else 'Schedule created, but scheduler restart failed - restart manually.'
+            'scheduler_updated': scheduler_updated,
+            'message': 'Schedule created and scheduler updated successfully!' if scheduler_updated
+                    else 'Schedule created, but scheduler update failed - restart manually.'
         }), 201
 
     except Exception as e:
@@ -179,13 +299,13 @@ def delete_schedule(schedule_id):
     try:
         db.delete_schedule(schedule_id)
         log.info(f"Deleted schedule {schedule_id}")
-        restart_success = restart_scheduler()
+        scheduler_updated = update_scheduler('remove_schedule', schedule_id)
 
         return jsonify({
             'success': True,
-            'scheduler_restarted': restart_success,
-            'message': 'Schedule deleted and scheduler restarted successfully!' if restart_success 
-                    else 'Schedule deleted, but scheduler restart failed - restart manually.'
+            'scheduler_updated': scheduler_updated,
+            'message': 'Schedule deleted and scheduler updated successfully!' if scheduler_updated
+                    else 'Schedule deleted, but scheduler update failed - restart manually.'
         }), 200
 
     except Exception as e:
@@ -250,14 +370,14 @@ def update_schedule(schedule_id):
         db.update_schedule(schedule_id, **updated_fields)
 
         log.info(f"Updated schedule {schedule_id}")
-        restart_success = restart_scheduler()
+        scheduler_updated = update_scheduler('reload_schedule', schedule_id)
 
         return jsonify({
             'success': True,
             'schedule_id': schedule_id,
-            'scheduler_restarted': restart_success,
-            'message': 'Schedule updated and scheduler restarted successfully!' if restart_success 
-                    else 'Schedule updated, but scheduler restart failed - restart manually.'
+            'scheduler_updated': scheduler_updated,
+            'message': 'Schedule updated and scheduler updated successfully!' if scheduler_updated
+                    else 'Schedule updated, but scheduler update failed - restart manually.'
         }), 200
 
     except Exception as e:
@@ -271,11 +391,11 @@ def update_schedule(schedule_id):
 # ============= THRESHOLDS ENDPOINTS =============
 
 @app.route('/api/thresholds/<client_id>', methods=['GET'])
+@cached('thresholds:{client_id}')
 def get_threshold(client_id):
     """Get threshold for a specific device"""
     try:
-        thresholds = db.get_all_thresholds()
-        threshold = next((t for t in thresholds if t['client_id'] == client_id), None)
+        threshold = db.get_threshold(client_id)
 
         if threshold:
             return jsonify({
@@ -329,6 +449,7 @@ def set_threshold(client_id):
 
         # Set threshold in database
         db.set_threshold(client_id, limit_kwh, reset_period)
+        notify_threshold_change(client_id)
 
         log.info(f"Set threshold for {client_id}: {limit_kwh} kWh ({reset_period})")
 
@@ -349,14 +470,8 @@ def set_threshold(client_id):
 def delete_threshold(client_id):
     """Delete threshold for a device"""
     try:
-        thresholds = db.get_all_thresholds()
-        threshold = next((t for t in thresholds if t['client_id'] == client_id), None)
-
-        if threshold:
-            db.disable_threshold(threshold['id'])
-            # Actually delete instead of just disabling
-            with db.get_connection() as conn:
-                conn.execute('DELETE FROM thresholds WHERE client_id = ?', (client_id,))
+        if db.delete_threshold(client_id):
+            notify_threshold_change(client_id)
 
             log.info(f"Deleted threshold for {client_id}")
             return jsonify({
@@ -379,7 +494,11 @@ def delete_threshold(client_id):
 
 # ============= ENERGY DATA ENDPOINTS =============
 
+# API period names -> consumption_totals reset periods
+PERIOD_RESETS = {'day': 'daily', 'week': 'weekly', 'month': 'monthly'}
+
 @app.route('/api/energy/<client_id>', methods=['GET'])
+@cached('readings:{client_id}')
 def get_energy_data(client_id):
     """
     Get energy consumption data for a device
@@ -391,55 +510,42 @@ def get_energy_data(client_id):
         limit = request.args.get('limit', 100, type=int)
         period = request.args.get('period', None)
 
-        with db.get_connection() as conn:
-            if period:
-                # Get current time in UTC
-                now_utc = datetime.now(timezone.utc)
-                
-                if period == 'day':
-                    period_start = now_utc.replace(hour=0, minute=0, second=0, microsecond=0)
-                elif period == 'week':
-                    days_since_monday = now_utc.weekday()
-                    period_start = (now_utc - timedelta(days=days_since_monday)).replace(
-                        hour=0, minute=0, second=0, microsecond=0
-                    )
-                elif period == 'month':
-                    period_start = now_utc.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                else:
-                    return jsonify({
-                        'success': False,
-                        'error': 'Invalid period. Use "day", "week", or "month"'
-                    }), 400
+        if period:
+            reset_period = PERIOD_RESETS.get(period)
+            if reset_period is None:
+                return jsonify({
+                    'success': False,
+                    'error': 'Invalid period. Use "day", "week", or "month"'
+                }), 400
 
-                # Convert to naive datetime (remove timezone info) since DB stores naive UTC
-                period_start = period_start.replace(tzinfo=None)
-                
-                consumption = db.get_consumption_since(client_id, period_start)
+            # Running total for the current UTC period, kept up to date on ingest
+            consumption = db.get_period_consumption(client_id, reset_period)
 
-                return jsonify({
-                    'success': True,
-                    'client_id': client_id,
-                    'period': period,
-                    'consumption_kwh': round(consumption, 3)
-                }), 200
-            else:
-                # Get recent readings
-                cursor = conn.execute('''
-                    SELECT energy_kwh, timestamp
-                    FROM energy_readings
-                    WHERE client_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT ?
-                ''', (client_id, limit))
-
-                readings = [{'energy_kwh': row['energy_kwh'], 'timestamp': row['timestamp']} 
-                           for row in cursor.fetchall()]
+            return jsonify({
+                'success': True,
+                'client_id': client_id,
+                'period': period,
+                'consumption_kwh': round(consumption, 3)
+            }), 200
 
-                return jsonify({
-                    'success': True,
-                    'client_id': client_id,
-                    'readings': readings
-                }), 200
+        # Get recent readings
+        with db.read_connection() as conn:
+            cursor = conn.execute('''
+                SELECT energy_kwh, timestamp
+                FROM energy_readings
+                WHERE client_id = ?
+                ORDER BY timestamp DESC
+                LIMIT ?
+            ''', (client_id, limit))
+
+            readings = [{'energy_kwh': row['energy_kwh'], 'timestamp': row['timestamp']}
+                        for row in cursor.fetchall()]
+
+        return jsonify({
+            'success': True,
+            'client_id': client_id,
+            'readings': readings
+        }), 200
 
     except Exception as e:
         log.error(f"Error getting energy data for {client_id}: {e}")
@@ -448,58 +554,529 @@ def get_energy_data(client_id):
             'error': str(e)
         }), 500
 
+# Keyset pagination for raw range queries
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 5000
+
+# Raw range formats that are streamed instead of built in memory
+STREAM_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# Rows per chunk written to a streamed response
+STREAM_CHUNK_ROWS = 500
+
+def encode_cursor(reading):
+    """Opaque pagination cursor for the (timestamp, id) key of a reading"""
+    key = f"{reading['timestamp']}|{reading['id']}"
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+def decode_cursor(cursor):
+    """(timestamp, id) from encode_cursor; raises ValueError if malformed"""
+    try:
+        timestamp, reading_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        return timestamp, int(reading_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor[:100]!r}")
+
+def iter_range_readings(client_id, start, end, after=None, limit=None):
+    """
+    Raw readings in (timestamp, id) order: archived ones first (they all
+    predate live rows), then the database. Passing the last archived key
+    on to the database query also skips rows that were archived but not
+    yet deleted.
+    """
+    if limit is not None and limit <= 0:
+        return
+
+    for reading in archive.iter_read(client_id, start or '0000', end or '9999', after):
+        yield reading
+        after = (reading['timestamp'], reading['id'])
+        if limit is not None:
+            limit -= 1
+            if limit == 0:
+                return
+
+    yield from db.iter_readings(client_id, start, end, after, limit)
+
+def stream_readings(client_id, readings, fmt):
+    """Chunked NDJSON/CSV response generated straight from a readings iterator"""
+    def generate():
+        if fmt == 'csv':
+            yield 'timestamp,energy_kwh\n'
+
+        chunk = []
+        try:
+            for r in readings:
+                if fmt == 'csv':
+                    chunk.append(f"{r['timestamp']},{r['energy_kwh']}\n")
+                else:
+                    chunk.append(json.dumps({'energy_kwh': r['energy_kwh'],
+                                             'timestamp': r['timestamp']}) + '\n')
+                if len(chunk) >= STREAM_CHUNK_ROWS:
+                    yield ''.join(chunk)
+                    chunk = []
+        except Exception as e:
+            # Headers are already sent; all we can do is cut the stream short
+            log.error(f"Error streaming readings for {client_id}: {e}")
+            raise
+        if chunk:
+            yield ''.join(chunk)
+
+    headers = {}
+    if fmt == 'csv':
+        headers['Content-Disposition'] = f'attachment; filename="{client_id}-energy.csv"'
+    return Response(stream_with_context(generate()), mimetype=STREAM_FORMATS[fmt],
+                    headers=headers)
+
 @app.route('/api/energy/<client_id>/range')
+@cached('readings:{client_id}')
 def get_energy_readings_by_range(client_id):
+    """
+    Get energy readings between two UTC timestamps
+    Query parameters:
+    - start, end: "YYYY-MM-DD HH:MM:SS"
+    - resolution: "raw" (default), "hour", "day", or "auto"
+      (auto picks raw/hour/day from the span, see pick_resolution)
+    - format: "json" (default), or "ndjson"/"csv" to stream raw readings
+    - page_size, cursor: page through raw readings (JSON only); pass the
+      returned next_cursor to get the following page
+    """
     start = request.args.get('start')
     end = request.args.get('end')
-    with db.get_connection() as conn:
-        cursor = conn.execute('''
-            SELECT energy_kwh, timestamp FROM energy_readings
-            WHERE client_id = ? AND timestamp >= ? AND timestamp <= ?
-            ORDER BY timestamp ASC
-        ''', (client_id, start, end))
-        readings = [dict(row) for row in cursor.fetchall()]
+    resolution = request.args.get('resolution', 'raw')
+    fmt = request.args.get('format', 'json')
+    cursor = request.args.get('cursor')
+    page_size = request.args.get('page_size', type=int)
+
+    if resolution not in ('raw', 'auto') + ROLLUP_RESOLUTIONS:
+        return jsonify({
+            'success': False,
+            'error': 'Invalid resolution. Use "raw", "hour", "day", or "auto"'
+        }), 400
+
+    if fmt != 'json' and fmt not in STREAM_FORMATS:
+        return jsonify({
+            'success': False,
+            'error': 'Invalid format. Use "json", "ndjson", or "csv"'
+        }), 400
+
+    paged = cursor is not None or page_size is not None
+    if paged and fmt != 'json':
+        return jsonify({
+            'success': False,
+            'error': 'page_size and cursor are only supported with format "json"'
+        }), 400
+
+    if resolution != 'raw':
+        try:
+            start_dt = datetime.strptime(start, TIMESTAMP_FORMAT)
+            end_dt = datetime.strptime(end, TIMESTAMP_FORMAT)
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'error': 'start and end must use "YYYY-MM-DD HH:MM:SS"'
+            }), 400
+
+        if resolution == 'auto':
+            resolution = pick_resolution(end_dt - start_dt)
+
+        if resolution != 'raw':
+            if fmt != 'json' or paged:
+                return jsonify({
+                    'success': False,
+                    'error': 'format, page_size and cursor apply to raw readings only'
+                }), 400
+            return jsonify({
+                'success': True,
+                'client_id': client_id,
+                'resolution': resolution,
+                'readings': db.get_rollups(client_id, resolution, start_dt, end_dt)
+            })
+
+    # Streamed exports may leave either bound open to get the whole history
+    if fmt in STREAM_FORMATS:
+        return stream_readings(client_id, iter_range_readings(client_id, start, end), fmt)
+
+    if paged:
+        if page_size is None:
+            page_size = DEFAULT_PAGE_SIZE
+        if not 1 <= page_size <= MAX_PAGE_SIZE:
+            return jsonify({
+                'success': False,
+                'error': f'page_size must be between 1 and {MAX_PAGE_SIZE}'
+            }), 400
+        try:
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        # Fetch one extra row to know whether there is a next page
+        rows = list(iter_range_readings(client_id, start, end, after, page_size + 1))
+        page = rows[:page_size]
+        return jsonify({
+            'success': True,
+            'client_id': client_id,
+            'readings': [{'energy_kwh': r['energy_kwh'], 'timestamp': r['timestamp']}
+                         for r in page],
+            'next_cursor': encode_cursor(page[-1]) if len(rows) > page_size else None
+        })
+
+    if not start or not end:
+        return jsonify({
+            'success': False,
+            'error': 'start and end are required (or use page_size/cursor or a streamed format)'
+        }), 400
+
+    readings = [{'energy_kwh': r['energy_kwh'], 'timestamp': r['timestamp']}
+                for r in iter_range_readings(client_id, start, end)]
     return jsonify({
         'success': True,
         'client_id': client_id,
         'readings': readings
     })
 
+def pick_resolution(span):
+    """Coarsest resolution that still gives a usable chart for the span"""
+    if span <= timedelta(days=2):
+        return 'raw'
+    elif span <= timedelta(days=62):
+        return 'hour'
+    return 'day'
+
+# Upper bound on buckets per aggregate request (about 35 days of 5m buckets)
+MAX_AGGREGATE_BUCKETS = 10000
+
+# Weekly power buckets start on Monday like the energy weeks (1970-01-05)
+WEEK_ORIGIN = 4 * 86400
+
+@app.route('/api/energy/<client_id>/aggregate', methods=['GET'])
+@cached('readings:{client_id}', 'power:{client_id}')
+def get_energy_aggregate(client_id):
+    """
+    Get energy consumption per time bucket for charts
+    Query parameters:
+    - start, end: "YYYY-MM-DD HH:MM:SS" (UTC)
+    - bucket: "5m", "1h" (default), "1d" or "1w"
+    """
+    try:
+        bucket = request.args.get('bucket', '1h')
+        if bucket not in AGGREGATE_BUCKETS:
+            return jsonify({
+                'success': False,
+                'error': 'Invalid bucket. Use "5m", "1h", "1d", or "1w"'
+            }), 400
+
+        try:
+            start = datetime.strptime(request.args.get('start'), TIMESTAMP_FORMAT)
+            end = datetime.strptime(request.args.get('end'), TIMESTAMP_FORMAT)
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'error': 'start and end must use "YYYY-MM-DD HH:MM:SS"'
+            }), 400
+
+        bucket_seconds = AGGREGATE_BUCKETS[bucket]
+        if (end - start).total_seconds() / bucket_seconds > MAX_AGGREGATE_BUCKETS:
+            return jsonify({
+                'success': False,
+                'error': f'Range too large for bucket {bucket} (max {MAX_AGGREGATE_BUCKETS} buckets)'
+            }), 400
+
+        buckets = db.get_aggregates(client_id, bucket, start, end)
+
+        # Power stats from pzem/metrics samples, where the device sent any
+        origin = WEEK_ORIGIN if bucket == '1w' else 0
+        power = {p['timestamp']: p for p in power_series.get_series(
+            client_id, start, end, bucket_seconds, origin=origin)}
+
+        for b in buckets:
+            p = power.get(b['timestamp'])
+            b['power_avg'] = p['power_avg'] if p else None
+            b['power_min'] = p['power_min'] if p else None
+            b['power_max'] = p['power_max'] if p else None
+
+        return jsonify({
+            'success': True,
+            'client_id': client_id,
+            'bucket': bucket,
+            'consumption_kwh': round(sum(b['consumption_kwh'] for b in buckets), 3),
+            'buckets': buckets
+        }), 200
+
+    except Exception as e:
+        log.error(f"Error aggregating energy for {client_id}: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+# ============= POWER METRICS ENDPOINT =============
+
+# Default number of points returned when no bucket size is given
+POWER_SERIES_POINTS = 500
+
+@app.route('/api/power/<client_id>', methods=['GET'])
+@cached('power:{client_id}')
+def get_power_series(client_id):
+    """
+    Get downsampled voltage/current/power history for a device
+    Query parameters:
+    - start, end: "YYYY-MM-DD HH:MM:SS" (UTC)
+    - bucket: bucket size in seconds (optional, default gives ~500 points)
+    """
+    try:
+        try:
+            start = datetime.strptime(request.args.get('start'), TIMESTAMP_FORMAT)
+            end = datetime.strptime(request.args.get('end'), TIMESTAMP_FORMAT)
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'error': 'start and end must use "YYYY-MM-DD HH:MM:SS"'
+            }), 400
+
+        span = max(int((end - start).total_seconds()), 1)
+        bucket = request.args.get('bucket', -(-span // POWER_SERIES_POINTS), type=int)
+        if bucket is None or bucket < 1:
+            return jsonify({
+                'success': False,
+                'error': 'bucket must be a positive number of seconds'
+            }), 400
+
+        return jsonify({
+            'success': True,
+            'client_id': client_id,
+            'bucket_seconds': bucket,
+            'series': power_series.get_series(client_id, start, end, bucket)
+        }), 200
+
+    except Exception as e:
+        log.error(f"Error getting power series for {client_id}: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 # ============= DEVICES ENDPOINT =============
 
+# Devices publish a heartbeat every 30 s; allow a few to be missed
+DEVICE_ONLINE_WINDOW = timedelta(seconds=120)
+
 @app.route('/api/devices', methods=['GET'])
+@cached('devices')
 def get_devices():
     """Get list of all known devices"""
     try:
-        with db.get_connection() as conn:
-            # Get unique client IDs from energy_readings
-            cursor = conn.execute('''
-                SELECT DISTINCT client_id, 
-                       MAX(timestamp) as last_seen,
-                       MAX(energy_kwh) as current_energy
-                FROM energy_readings
-                GROUP BY client_id
-                ORDER BY last_seen DESC
-            ''')
+        online_after = (utc_now() - DEVICE_ONLINE_WINDOW).strftime(TIMESTAMP_FORMAT)
+        devices = []
+
+        # Served from the device registry maintained by the scheduler
+        for device in db.get_devices():
+            last_seen = device['last_seen'] or device['first_seen']
+            devices.append({
+                'client_id': device['client_id'],
+                'last_seen': last_seen,
+                'current_energy_kwh': device['last_energy_kwh'],
+                'status': device['status'],
+                'online': device['status'] != 'Offline' and last_seen >= online_after,
+                'relay_state': device['relay_state']
+            })
+
+        return jsonify({
+            'success': True,
+            'devices': devices
+        }), 200
+
+    except Exception as e:
+        log.error(f"Error getting devices: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
 
-            devices = [{'client_id': row['client_id'], 
-                       'last_seen': row['last_seen'],
-                       'current_energy_kwh': row['current_energy']} 
-                      for row in cursor.fetchall()]
 
+# ============= FLEET ENDPOINT =============
+
+# client_ids per fleet request (keeps the IN (...) list under SQLite's
+# bound-parameter limit)
+MAX_FLEET_CLIENT_IDS = 500
+
+@app.route('/api/fleet/summary', methods=['GET'])
+@cached('devices', 'thresholds')
+def get_fleet_summary():
+    """
+    Get consumption, threshold state and last-seen for many devices at once
+    Query parameters:
+    - period: "day" (default), "week", or "month"
+    - client_ids: comma-separated device IDs (optional, default all devices)
+    """
+    try:
+        period = request.args.get('period', 'day')
+        reset_period = PERIOD_RESETS.get(period)
+        if reset_period is None:
             return jsonify({
-                'success': True,
-                'devices': devices
-            }), 200
+                'success': False,
+                'error': 'Invalid period. Use "day", "week", or "month"'
+            }), 400
+
+        client_ids = request.args.get('client_ids')
+        if client_ids is not None:
+            client_ids = [c for c in client_ids.split(',') if c]
+            if len(client_ids) > MAX_FLEET_CLIENT_IDS:
+                return jsonify({
+                    'success': False,
+                    'error': f'At most {MAX_FLEET_CLIENT_IDS} client_ids per request'
+                }), 400
+
+        online_after = (utc_now() - DEVICE_ONLINE_WINDOW).strftime(TIMESTAMP_FORMAT)
+        devices = []
+
+        for row in db.get_fleet_summary(reset_period, client_ids):
+            last_seen = row['last_seen'] or row['first_seen']
+
+            threshold = None
+            if row['limit_kwh'] is not None:
+                threshold = {
+                    'limit_kwh': row['limit_kwh'],
+                    'reset_period': row['threshold_period'],
+                    'enabled': bool(row['threshold_enabled']),
+                    'consumption_kwh': round(row['threshold_consumption_kwh'], 3),
+                    'percent_used': round(100 * row['threshold_consumption_kwh'] / row['limit_kwh'], 1)
+                                    if row['limit_kwh'] > 0 else None
+                }
+
+            devices.append({
+                'client_id': row['client_id'],
+                'last_seen': last_seen,
+                'online': row['status'] != 'Offline' and last_seen >= online_after,
+                'status': row['status'],
+                'relay_state': row['relay_state'],
+                'current_energy_kwh': row['last_energy_kwh'],
+                'consumption_kwh': round(row['consumption_kwh'], 3),
+                'threshold': threshold
+            })
+
+        return jsonify({
+            'success': True,
+            'period': period,
+            'total_consumption_kwh': round(sum(d['consumption_kwh'] for d in devices), 3),
+            'devices': devices
+        }), 200
 
     except Exception as e:
-        log.error(f"Error getting devices: {e}")
+        log.error(f"Error getting fleet summary: {e}")
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
 
+# ============= RELAY COMMANDS ENDPOINT =============
+
+@app.route('/api/relay/commands', methods=['GET'])
+def get_relay_commands():
+    """
+    Relay commands sent by the scheduler that are awaiting confirmation or
+    were given up on, plus actuation latency per device
+    Query parameters:
+    - client_id: only this device (optional)
+    """
+    params = {}
+    if request.args.get('client_id'):
+        params['client_id'] = request.args['client_id']
+
+    try:
+        response = send_command('relay_commands', **params)
+    except Exception as e:
+        log.warning(f"Scheduler control socket unavailable: {e}")
+        return jsonify({
+            'success': False,
+            'error': 'Scheduler is not reachable'
+        }), 503
+
+    if not response.pop('success', False):
+        return jsonify({
+            'success': False,
+            'error': response.get('error', 'Unknown error')
+        }), 500
+
+    return jsonify({'success': True, **response}), 200
+
+
+# ============= LIVE FEED ENDPOINT =============
+
+# Comment line sent when there is nothing to push, so dead connections are noticed
+LIVE_KEEPALIVE_SECONDS = 15
+
+@app.route('/api/live', methods=['GET'])
+def live_events():
+    """
+    Server-Sent Events stream of live readings and device state
+    Query parameters:
+    - client_ids: comma-separated device IDs (optional, default all)
+    - types: comma-separated event types (optional, default all):
+      energy, metrics, status, relay_state, threshold_alert
+    """
+    client_ids = [c for c in request.args.get('client_ids', '').split(',') if c] or None
+    types = [t for t in request.args.get('types', '').split(',') if t] or None
+
+    if types and not set(types) <= set(EVENT_TYPES):
+        return jsonify({
+            'success': False,
+            'error': f'Invalid types. Use any of: {", ".join(EVENT_TYPES)}'
+        }), 400
+
+    try:
+        subscription = live_feed.subscribe(client_ids, types)
+    except Exception as e:
+        log.error(f"Live feed unavailable: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 503
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                events = subscription.get(LIVE_KEEPALIVE_SECONDS)
+                if not events:
+                    yield ': keepalive\n\n'
+                    continue
+                yield ''.join(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                              for event in events)
+        finally:
+            # Runs when the client disconnects and the next write fails
+            subscription.close()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# ============= METRICS ENDPOINT =============
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus text exposition of this API worker's metrics plus the
+    scheduler's (read over the control socket, best effort). Samples are
+    labelled process="api" (with the worker pid) or process="scheduler".
+    """
+    scheduler_families = []
+    try:
+        response = send_command('metrics', timeout=1.0)
+        if not response.get('success'):
+            raise RuntimeError(response.get('error'))
+        scheduler_families = with_labels(response['families'], process='scheduler')
+        SCHEDULER_UP.set(1)
+    except Exception as e:
+        log.warning(f"Could not read scheduler metrics: {e}")
+        SCHEDULER_UP.set(0)
+
+    api_families = with_labels(REGISTRY.collect(), process='api', pid=os.getpid())
+    return Response(render(api_families, scheduler_families),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # ============= HEALTH CHECK =============
 
 @app.route('/api/health', methods=['GET'])
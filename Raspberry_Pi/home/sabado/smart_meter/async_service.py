@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+import asyncio
+import inspect
+import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ingest import IngestQueue, INGEST_FLUSH_SECONDS
+from mqtt_client import MQTTSchedulerClient
+from scheduler import SmartMeterScheduler, THRESHOLD_CHECK_SECONDS
+
+log = logging.getLogger("async-service")
+
+# How long a job or tracker thread waits for the loop to run its publish
+PUBLISH_TIMEOUT = 10
+
+class AsyncMQTTClient(MQTTSchedulerClient):
+    """
+    MQTTSchedulerClient driven by the asyncio event loop instead of
+    paho's network thread: the socket is watched with add_reader and
+    add_writer, so message callbacks run on the loop. Keepalives and
+    reconnects (with backoff) are handled by a task started in connect().
+
+    Relay commands and alerts published from other threads (APScheduler
+    jobs, the relay tracker, the shard receiver) are handed to the loop,
+    and the caller waits there for the MQTTMessageInfo.
+    """
+
+    def __init__(self, broker, port, client_id="scheduler-service"):
+        super().__init__(broker, port, client_id)
+        self.loop = None
+        self._loop_thread = None
+        self._task = None
+
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def connect(self):
+        """Start the connection task (call from the running loop)"""
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._task = self.loop.create_task(self._run())
+
+    def disconnect(self):
+        """Stop reconnecting and send DISCONNECT (flushed once the loop runs again)"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.client.disconnect()
+
+    async def _run(self):
+        """Connect, then service keepalives once a second, reconnecting when the socket is gone"""
+        delay = 1
+        while True:
+            if self.client.socket() is None:
+                log.info(f"Connecting to MQTT broker at {self.broker}:{self.port}")
+                try:
+                    # connect() blocks on the TCP handshake, keep it off the loop
+                    await self.loop.run_in_executor(None, self.client.connect,
+                                                    self.broker, self.port, 60)
+                    delay = 1
+                except OSError as e:
+                    log.warning(f"Connection to MQTT broker failed ({e}), retrying in {delay}s")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60)
+                    continue
+
+            self.client.loop_misc()
+            await asyncio.sleep(1)
+
+    def _on_loop(self, func, *args):
+        """Run func on the loop and return its result, waiting for it from other threads"""
+        if self._loop_thread in (None, threading.get_ident()) or not self.loop.is_running():
+            return func(*args)
+
+        async def run():
+            return func(*args)
+
+        future = asyncio.run_coroutine_threadsafe(run(), self.loop)
+        try:
+            return future.result(PUBLISH_TIMEOUT)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def publish_relay_command(self, client_id, command):
+        return self._on_loop(super().publish_relay_command, client_id, command)
+
+    def publish_relay_commands(self, client_ids, command):
+        # One hop for the whole burst
+        return self._on_loop(super().publish_relay_commands, client_ids, command)
+
+    def publish_threshold_alert(self, client_id, consumption, limit):
+        return self._on_loop(super().publish_threshold_alert, client_id, consumption, limit)
+
+    # paho calls these from whichever thread touched the socket: the loop
+    # for reads and writes and an executor thread while connecting. Removal
+    # has to happen before paho closes the socket, so it is done directly
+    # when already on the loop.
+
+    def _call(self, func, *args):
+        if self._loop_thread == threading.get_ident():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _watch(self, sock, add, callback):
+        # Deferred from another thread: the socket may have closed since
+        if self.client.socket() is sock:
+            add(sock, callback)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._watch, sock, self.loop.add_reader, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self.loop.remove_reader, sock.fileno())
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self._watch, sock, self.loop.add_writer, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock.fileno())
+
+class AsyncIngestQueue(IngestQueue):
+    """
+    IngestQueue whose writer is a task on the running event loop.
+
+    Batches are collected the same way, but write_batch runs in executor
+    (a thread pool) so the loop keeps handling messages during the write.
+    If on_written is a coroutine function it is scheduled as its own task
+    rather than holding up the next batch. put() must be called on the
+    loop's thread, which is where AsyncMQTTClient delivers messages.
+    """
+
+    def __init__(self, write_batch, name="ingest", max_size=10000,
+                 batch_size=500, flush_interval=2.0, on_written=None, executor=None):
+        super().__init__(write_batch, name, max_size, batch_size, flush_interval, on_written)
+        self.executor = executor
+
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._stopping = None
+        self._task = None
+        # Post-write tasks still running (kept referenced until done)
+        self._pending = set()
+
+    def start(self):
+        """Start the writer task (call from the running loop)"""
+        if self._task and not self._task.done():
+            return
+        self._stopping = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        log.info(f"{self.name}: writer started (batch={self.batch_size}, "
+                 f"interval={self.flush_interval}s, max={self._queue.maxsize})")
+
+    def put(self, item):
+        """
+        Queue an item without blocking the loop.
+        Returns False (and counts a drop) when the queue is full.
+        """
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            # Log the first drop and then every 1000th to avoid flooding
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                log.warning(f"{self.name}: queue full, dropped {self.dropped} item(s) so far")
+            return False
+        self.enqueued += 1
+        return True
+
+    async def stop(self, timeout=10):
+        """Stop the writer task after flushing everything still queued"""
+        if self._task:
+            self._stopping.set()
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                log.warning(f"{self.name}: writer did not stop within {timeout}s")
+            self._task = None
+
+        # Anything queued after the writer exited is flushed here
+        await self._drain()
+        if self._pending:
+            await asyncio.wait(self._pending, timeout=timeout)
+        log.info(f"{self.name}: stopped ({self.stats()})")
+
+    async def _run(self):
+        """Writer loop: collect a batch, flush, repeat"""
+        loop = asyncio.get_running_loop()
+        while not self._stopping.is_set():
+            try:
+                first = await asyncio.wait_for(self._queue.get(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                # Take what is already queued before waiting for more
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self._stopping.is_set():
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._flush(batch)
+
+        await self._drain()
+
+    async def _drain(self):
+        """Flush all queued items in batch_size chunks"""
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            if not batch:
+                return
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        """Hand one batch to the writer in the executor, never letting an error kill the task"""
+        started = time.monotonic()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._write, batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            log.error(f"{self.name}: failed to write batch of {len(batch)}: {e}")
+            return
+        finally:
+            self.last_flush_seconds = time.monotonic() - started
+            INGEST_FLUSH_SECONDS.observe(self.last_flush_seconds, queue=self.name)
+
+        if self.on_written:
+            try:
+                result = self.on_written(batch)
+            except Exception as e:
+                log.error(f"{self.name}: post-write handler failed: {e}")
+                return
+            if inspect.isawaitable(result):
+                task = asyncio.ensure_future(self._await_written(result))
+                self._pending.add(task)
+                task.add_done_callback(self._pending.discard)
+
+    async def _await_written(self, result):
+        try:
+            await result
+        except Exception as e:
+            log.error(f"{self.name}: post-write handler failed: {e}")
+
+class AsyncSmartMeterService(SmartMeterScheduler):
+    """
+    SmartMeterScheduler with message handling, batched writes, threshold
+    evaluation and relay publishing as tasks on one event loop.
+
+    MQTT I/O and message callbacks run on the loop (AsyncMQTTClient),
+    ingest batches are written on a single database thread, and threshold
+    checks triggered by a write run as coroutines that read consumption
+    in the default executor. Schedules, the threshold sweep, retention and
+    the control socket are shared with the threaded service unchanged;
+    their jobs still run on APScheduler's threads, but the relay commands
+    they send are published from the loop.
+    """
+
+    mqtt_client_class = AsyncMQTTClient
+    ingest_queue_class = AsyncIngestQueue
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # SQLite has a single writer: ingest batches take turns on one thread
+        # instead of contending for the write lock from three
+        self.write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        for ingest in (self.ingest, self.power_ingest, self.device_ingest):
+            ingest.executor = self.write_executor
+
+    async def run(self):
+        """Start all services on the running loop and serve until SIGINT/SIGTERM"""
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopping.set)
+
+        # Startup is synchronous (database reads, schedule sync) and
+        # finishes before the loop handles the first message
+        self.start()
+        await stopping.wait()
+        await self.stop()
+
+    async def handle_readings_written(self, readings):
+        """Evaluate thresholds of devices that just had readings stored, concurrently"""
+        with THRESHOLD_CHECK_SECONDS.time(trigger='ingest'):
+            client_ids = {reading[0] for reading in readings if reading[0] in self.thresholds}
+            results = await asyncio.gather(*(self.evaluate_threshold_async(client_id)
+                                             for client_id in client_ids),
+                                           return_exceptions=True)
+        for client_id, result in zip(client_ids, results):
+            if isinstance(result, Exception):
+                log.error(f"Threshold check for {client_id} failed: {result}")
+
+    async def evaluate_threshold_async(self, client_id):
+        """evaluate_threshold with the database calls awaited in executors"""
+        threshold = self.thresholds.get(client_id)
+        if not threshold:
+            return
+
+        loop = asyncio.get_running_loop()
+        consumption = await loop.run_in_executor(
+            None, self.db.get_period_consumption, client_id, threshold['reset_period'])
+
+        # Publishing is non-blocking: paho queues the packet for the loop's writer
+        if self.trip_threshold(client_id, threshold, consumption):
+            await loop.run_in_executor(self.write_executor, self.disable_tripped, threshold)
+
+    async def stop(self):
+        """Stop all services, flushing queued data"""
+        log.info("Shutting down scheduler...")
+        loop = asyncio.get_running_loop()
+        self.control.stop()
+        # Running jobs may be waiting on broker acks, which need the loop
+        await loop.run_in_executor(None, self.scheduler.shutdown)
+        if self.shards:
+            await loop.run_in_executor(None, self.shards.stop)
+        # The tracker thread may be waiting for the loop to publish a retry
+        await loop.run_in_executor(None, self.relay_tracker.stop)
+        self.mqtt.disconnect()
+
+        # Flush readings still waiting in the ingest queues
+        await asyncio.gather(self.ingest.stop(), self.power_ingest.stop(), self.device_ingest.stop())
+        self.write_executor.shutdown()
+        self.db.close()
+
+if __name__ == '__main__':
+    asyncio.run(AsyncSmartMeterService().run())
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+REST API latency benchmark.
+
+Seeds a scratch scheduler.db with one or more simulated fleets (devices x
+days of energy readings, plus schedules and thresholds) and measures
+p50/p99 latency and throughput of the api.py endpoints through Flask's
+test client. Results are printed as JSON.
+
+The API never talks to a real scheduler: a stand-in control socket
+acknowledges the reload commands sent by the schedule/threshold endpoints.
+
+Examples:
+    python3 benchmarks/bench_api.py --devices 10,100 --days 365
+    python3 benchmarks/bench_api.py --devices 1000 --days 30 --reading-interval 300
+    python3 benchmarks/bench_api.py --devices 100 --data-dir /tmp/bench-api --keep
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# api and control are imported in run(), once HOME points at the scratch
+# directory: they derive their paths from $HOME at import time
+api = None
+
+from database import Database, utc_now, TIMESTAMP_FORMAT
+from power_series import PowerSeriesStore
+from retention import ReadingArchive
+
+log = logging.getLogger("bench-api")
+
+SEED_BATCH = 5000
+
+def seed(db, devices, days, reading_interval, rng):
+    """
+    Store days worth of cumulative energy readings for every device,
+    ending now, through the normal ingest path (totals, rollups and the
+    device registry are maintained as they are in production)
+    """
+    client_ids = [f"ESP32-{i:08x}" for i in range(devices)]
+    energy = {client_id: rng.uniform(0, 50) for client_id in client_ids}
+
+    now = utc_now().replace(microsecond=0)
+    at = now - timedelta(days=days)
+    step = timedelta(seconds=reading_interval)
+    batch = []
+    stored = 0
+
+    while at <= now:
+        timestamp = at.strftime(TIMESTAMP_FORMAT)
+        for client_id in client_ids:
+            if rng.random() < 0.0005:
+                energy[client_id] = 0.0
+            else:
+                energy[client_id] += rng.uniform(0, 0.02) * reading_interval / 60
+            batch.append((client_id, round(energy[client_id], 3), timestamp))
+
+        if len(batch) >= SEED_BATCH:
+            db.store_energy_readings(batch)
+            stored += len(batch)
+            batch = []
+        at += step
+
+    if batch:
+        db.store_energy_readings(batch)
+        stored += len(batch)
+
+    for client_id in client_ids:
+        db.add_schedule(client_id, 'daily', start_time='08:00', end_time='20:00',
+                        days_of_week='0,1,2,3,4')
+        db.add_schedule(client_id, 'timer', duration_seconds=3600)
+        db.set_threshold(client_id, 5.0, 'daily')
+
+    return client_ids, stored
+
+def build_cases(client_ids, schedule_ids, rng):
+    """(name, method, url factory, json body factory) for each endpoint"""
+    now = utc_now().replace(microsecond=0)
+
+    def ago(**kwargs):
+        return (now - timedelta(**kwargs)).strftime(TIMESTAMP_FORMAT)
+
+    end = now.strftime(TIMESTAMP_FORMAT)
+
+    def device():
+        return rng.choice(client_ids)
+
+    return [
+        ('devices', 'GET', lambda: '/api/devices', None),
+        ('energy_recent', 'GET', lambda: f'/api/energy/{device()}', None),
+        ('energy_period_day', 'GET', lambda: f'/api/energy/{device()}?period=day', None),
+        ('energy_period_month', 'GET', lambda: f'/api/energy/{device()}?period=month', None),
+        ('range_raw_1d', 'GET',
+         lambda: f'/api/energy/{device()}/range?start={ago(days=1)}&end={end}', None),
+        ('range_raw_7d', 'GET',
+         lambda: f'/api/energy/{device()}/range?start={ago(days=7)}&end={end}', None),
+        ('range_hour_30d', 'GET',
+         lambda: f'/api/energy/{device()}/range?start={ago(days=30)}&end={end}&resolution=hour', None),
+        ('range_auto_365d', 'GET',
+         lambda: f'/api/energy/{device()}/range?start={ago(days=365)}&end={end}&resolution=auto', None),
+        ('schedules_all', 'GET', lambda: '/api/schedules', None),
+        ('schedules_device', 'GET', lambda: f'/api/schedules/{device()}', None),
+        ('schedule_update', 'PUT', lambda: f'/api/schedules/{rng.choice(schedule_ids)}',
+         lambda: {'start_time': f"{rng.randint(0, 11):02d}:00", 'end_time': f"{rng.randint(12, 23):02d}:00"}),
+        ('threshold_get', 'GET', lambda: f'/api/thresholds/{device()}', None),
+        ('threshold_set', 'PUT', lambda: f'/api/thresholds/{device()}',
+         lambda: {'limit_kwh': round(rng.uniform(1, 10), 1), 'reset_period': 'daily'}),
+        ('health', 'GET', lambda: '/api/health', None),
+    ]
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def measure(client, method, url, body, requests, warmup):
+    """Latency summary for one endpoint; url and body are factories"""
+    latencies = []
+    errors = 0
+    for n in range(warmup + requests):
+        path = url()
+        payload = body() if body else None
+        started = time.perf_counter()
+        response = client.open(path, method=method, json=payload)
+        elapsed = time.perf_counter() - started
+        if n < warmup:
+            continue
+        latencies.append(elapsed)
+        if response.status_code >= 400:
+            errors += 1
+
+    total = sum(latencies)
+    return {
+        'requests': requests,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'mean_ms': round(total / len(latencies) * 1000, 3),
+        'requests_per_second': round(len(latencies) / total, 1) if total else None,
+    }
+
+def db_size(db_path):
+    """Database size including the WAL and shared-memory index"""
+    total = 0
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            total += os.path.getsize(db_path + suffix)
+    return total
+
+def run_fleet(args, devices, base_dir):
+    data_dir = args.data_dir or f"{base_dir}/smart_meter"
+    data_dir = os.path.join(data_dir, f"fleet-{devices}")
+    os.makedirs(data_dir, exist_ok=True)
+    db_path = f"{data_dir}/scheduler.db"
+    reuse = os.path.exists(db_path)
+
+    rng = random.Random(args.seed)
+    db = Database(db_path)
+
+    seed_seconds = 0.0
+    if reuse:
+        client_ids = [d['client_id'] for d in db.get_devices()]
+        with db.read_connection() as conn:
+            stored = conn.execute('SELECT COUNT(*) FROM energy_readings').fetchone()[0]
+    else:
+        started = time.monotonic()
+        client_ids, stored = seed(db, devices, args.days, args.reading_interval, rng)
+        seed_seconds = time.monotonic() - started
+
+    schedule_ids = [s['id'] for s in db.get_all_schedules()]
+
+    # Point the API module at this fleet's database
+    api.db = db
+    api.power_series = PowerSeriesStore(db)
+    api.archive = ReadingArchive(f"{data_dir}/archive")
+    api.response_cache.clear()
+
+    client = api.app.test_client()
+    results = {}
+    for name, method, url, body in build_cases(client_ids, schedule_ids, rng):
+        results[name] = measure(client, method, url, body, args.requests, args.warmup)
+
+    db.close()
+    db_bytes = db_size(db_path)
+
+    return {
+        'devices': len(client_ids),
+        'readings': stored,
+        'reused_database': reuse,
+        'seed_seconds': round(seed_seconds, 1),
+        'db_bytes': db_bytes,
+        'endpoints': results,
+    }
+
+def run(args, base_dir):
+    """Point the API at base_dir, answer its control commands and measure each fleet"""
+    global api
+    os.environ['HOME'] = base_dir
+    os.makedirs(f"{base_dir}/smart_meter", exist_ok=True)
+    import api
+    from control import ControlServer
+
+    # api.py configures INFO logging on import; keep the output clean
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.no_cache:
+        api.response_cache.max_entries = 0
+
+    # Acknowledge hot-reload commands like the real scheduler would
+    control = ControlServer({
+        'reload_schedule': lambda schedule_id: {},
+        'remove_schedule': lambda schedule_id: {},
+        'reload_threshold': lambda client_id: {},
+    })
+    control.start()
+
+    try:
+        return [run_fleet(args, int(n), base_dir) for n in args.devices.split(',')]
+    finally:
+        control.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', default='10,100',
+                        help='comma-separated fleet sizes, one database each')
+    parser.add_argument('--days', type=int, default=365, help='days of readings to seed')
+    parser.add_argument('--reading-interval', type=int, default=900,
+                        help='seconds between seeded readings per device')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per endpoint')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the API response cache (measure the queries themselves)')
+    parser.add_argument('--data-dir',
+                        help='keep seeded databases here and reuse them on later runs')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    parser.add_argument('--output', help='write JSON results to this file as well as stdout')
+    args = parser.parse_args()
+
+    # Created after parsing, so --help and usage errors leave nothing behind
+    base_dir = tempfile.mkdtemp(prefix="bench-api-")
+    try:
+        fleets = run(args, base_dir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    results = {
+        'benchmark': 'api',
+        'config': {
+            'days': args.days,
+            'reading_interval_seconds': args.reading_interval,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'seed': args.seed,
+            'response_cache': not args.no_cache,
+        },
+        'fleets': fleets,
+    }
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+End-to-end ingestion benchmark.
+
+Drives MQTTSchedulerClient / SmartMeterScheduler with a simulated ESP32
+fleet and reports sustained readings/sec, publish-to-commit latency
+percentiles, ingest queue depth and database growth as JSON.
+
+By default messages are injected in-process through the client's
+on_message callback (the same path paho's network thread uses). With
+--broker the fleet publishes through a real MQTT broker instead.
+
+Examples:
+    python3 benchmarks/bench_ingest.py --devices 300 --interval 1 --duration 30
+    python3 benchmarks/bench_ingest.py --devices 1000 --interval 0 --duration 20
+    python3 benchmarks/bench_ingest.py --broker localhost:1883 --devices 100
+    python3 benchmarks/bench_ingest.py --devices 1000 --interval 0 --duration 20 --shards 2
+
+With --shards the readings are written by the shard processes. Their
+counters are collected when the service stops, so readings_per_second
+includes the final flush, and latency is not measured.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import SmartMeterScheduler
+
+log = logging.getLogger("bench-ingest")
+
+class FakeMessage:
+    """Just enough of paho's MQTTMessage for _on_message"""
+
+    def __init__(self, topic, payload, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+
+class InProcessBroker:
+    """
+    Stand-in for paho.mqtt.client.Client: connecting is a no-op and
+    outgoing publishes (relay commands, alerts) are only counted
+    """
+
+    def __init__(self):
+        self.published = 0
+
+    def connect(self, host, port, keepalive):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def subscribe(self, topics):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+class Fleet:
+    """Simulated ESP32 meters with cumulative, occasionally resetting energy"""
+
+    def __init__(self, devices, reset_rate, duplicate_rate, out_of_order_rate, seed):
+        self.rng = random.Random(seed)
+        self.client_ids = [f"ESP32-{i:08x}" for i in range(devices)]
+        self.energy = {client_id: self.rng.uniform(0, 500) for client_id in self.client_ids}
+        self.reset_rate = reset_rate
+        self.duplicate_rate = duplicate_rate
+        self.out_of_order_rate = out_of_order_rate
+        self.held = None
+
+    def messages(self, client_id):
+        """Energy messages produced by one publish of a device (0, 1 or 2)"""
+        if self.rng.random() < self.reset_rate:
+            self.energy[client_id] = 0.0
+        else:
+            self.energy[client_id] += self.rng.uniform(0.001, 0.05)
+
+        message = (f"dev/{client_id}/pzem/energy", f"{self.energy[client_id]:.2f}".encode())
+        out = [message]
+
+        if self.rng.random() < self.duplicate_rate:
+            out.append(message)
+
+        # Out of order: hold this message back and release it after the next one
+        if self.held is None and self.rng.random() < self.out_of_order_rate:
+            self.held = out
+            return []
+        if self.held is not None:
+            out, self.held = out + self.held, None
+        return out
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def shard_totals(shards):
+    """Energy ingest and reading filter counters summed over all shards"""
+    stats, filter_stats = {}, {}
+    for shard in shards:
+        for key, value in (shard['ingest'] or {}).get('energy-ingest', {}).items():
+            stats[key] = stats.get(key, 0) + value
+        for key, value in (shard['reading_filter'] or {}).items():
+            filter_stats[key] = filter_stats.get(key, 0) + value
+    stats['last_flush_seconds'] = None
+    return stats, filter_stats
+
+def db_size(data_dir):
+    """Database size including the WAL and shared-memory index"""
+    total = 0
+    for suffix in ('', '-wal', '-shm'):
+        path = os.path.join(data_dir, 'scheduler.db' + suffix)
+        if os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+def run(args):
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bench-ingest-")
+    os.makedirs(data_dir, exist_ok=True)
+
+    if args.broker:
+        host, _, port = args.broker.partition(':')
+        service = SmartMeterScheduler(data_dir=data_dir, broker=host, port=int(port or 1883),
+                                      shards=args.shards)
+    else:
+        service = SmartMeterScheduler(data_dir=data_dir, shards=args.shards)
+        service.mqtt.client = InProcessBroker()
+    if service.shards:
+        # Shard processes log at INFO too, and don't inherit the levels set in main()
+        service.shards.log_level = logging.WARNING
+
+    # Record publish -> commit latency by wrapping the batch writer
+    sent = {}
+    latencies = []
+    write_batch = service.ingest.write_batch
+
+    def timed_write(batch):
+        write_batch(batch)
+        committed = time.monotonic()
+        for client_id, energy_kwh, _ in batch:
+            published = sent.pop((client_id, round(energy_kwh, 2)), None)
+            if published is not None:
+                latencies.append(committed - published)
+
+    service.ingest.write_batch = timed_write
+
+    if args.broker:
+        import paho.mqtt.client as mqtt
+        publisher = mqtt.Client(client_id="bench-ingest-fleet")
+        publisher.connect(host, int(port or 1883), 60)
+        publisher.loop_start()
+
+        def publish(topic, payload):
+            publisher.publish(topic, payload, qos=0)
+    else:
+        def publish(topic, payload):
+            service.mqtt._on_message(None, None, FakeMessage(topic, payload))
+
+    fleet = Fleet(args.devices, args.reset_rate, args.duplicate_rate,
+                  args.out_of_order_rate, args.seed)
+    size_before = db_size(data_dir)
+    service.start()
+    time.sleep(0.5 if args.broker else 0)
+
+    depths = []
+    stop_sampling = threading.Event()
+
+    def sample_depth():
+        while not stop_sampling.wait(0.1):
+            depths.append(service.ingest.depth())
+
+    sampler = threading.Thread(target=sample_depth, daemon=True)
+    sampler.start()
+
+    # Spread publishes evenly: each device publishes once per interval.
+    # interval 0 publishes as fast as possible.
+    rate = args.devices / args.interval if args.interval > 0 else None
+    started = time.monotonic()
+    published = 0
+    n = 0
+
+    while time.monotonic() - started < args.duration:
+        client_id = fleet.client_ids[n % args.devices]
+        for topic, payload in fleet.messages(client_id):
+            sent.setdefault((client_id, float(payload)), time.monotonic())
+            publish(topic, payload)
+            published += 1
+        n += 1
+
+        if rate:
+            ahead = started + n / rate - time.monotonic()
+            if ahead > 0:
+                time.sleep(ahead)
+
+    publish_seconds = time.monotonic() - started
+
+    # Let the writer catch up: an empty queue is not enough, the writer may
+    # still hold a batch it is filling until flush_interval runs out
+    def settled():
+        return service.ingest.written + service.ingest.failed >= service.ingest.enqueued
+
+    while not settled() and time.monotonic() - started < args.duration + 30:
+        time.sleep(0.05)
+    stop_sampling.set()
+    sampler.join()
+
+    # Read after stop(), which flushes anything still left
+    if args.shards:
+        # Shards report their final counters while stopping
+        service.stop()
+        drain_seconds = time.monotonic() - started
+        stats, filter_stats = shard_totals(service.shards.status()['shards'])
+    else:
+        drain_seconds = time.monotonic() - started
+        service.stop()
+        stats, filter_stats = service.ingest.stats(), service.reading_filter.stats()
+    if args.broker:
+        publisher.loop_stop()
+        publisher.disconnect()
+
+    size_after = db_size(data_dir)
+    written = stats['written']
+
+    results = {
+        'benchmark': 'ingest',
+        'config': {
+            'devices': args.devices,
+            'interval_seconds': args.interval,
+            'duration_seconds': args.duration,
+            'reset_rate': args.reset_rate,
+            'duplicate_rate': args.duplicate_rate,
+            'out_of_order_rate': args.out_of_order_rate,
+            'transport': 'broker' if args.broker else 'in-process',
+            'shards': args.shards,
+            'batch_size': service.ingest.batch_size,
+            'flush_interval': service.ingest.flush_interval,
+        },
+        'published': published,
+        'publish_rate': round(published / publish_seconds, 1),
+        'ingest': stats,
+        'reading_filter': filter_stats,
+        'readings_per_second': round(written / drain_seconds, 1),
+        'latency_ms': {
+            'samples': len(latencies),
+            'p50': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            'p95': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            'p99': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+            'max': round(max(latencies) * 1000, 2) if latencies else None,
+        },
+        'queue_depth': {
+            'max': max(depths) if depths else 0,
+            'mean': round(sum(depths) / len(depths), 1) if depths else 0,
+        },
+        'db_bytes': {
+            'before': size_before,
+            'after': size_after,
+            'per_reading': round((size_after - size_before) / written, 1) if written else None,
+        },
+    }
+
+    if not args.data_dir and not args.keep:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=100, help='simulated meters')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between publishes per device (0 = as fast as possible)')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds to publish for')
+    parser.add_argument('--reset-rate', type=float, default=0.001, help='chance a publish follows a meter reset')
+    parser.add_argument('--duplicate-rate', type=float, default=0.01, help='chance a message is sent twice')
+    parser.add_argument('--out-of-order-rate', type=float, default=0.01, help='chance a message is delayed past the next one')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--broker', help='host[:port] of a real MQTT broker (default: in-process)')
+    parser.add_argument('--shards', type=int, default=0, help='ingest shard processes (default: ingest in-process)')
+    parser.add_argument('--data-dir', help='directory for scheduler.db (default: temporary, removed afterwards)')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary data directory')
+    parser.add_argument('--output', help='write JSON results to this file as well as stdout')
+    args = parser.parse_args()
+
+    # scheduler.py configures INFO logging on import; keep the output clean.
+    # Queue-full drops are reported in the results instead of logged.
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("ingest").setLevel(logging.ERROR)
+    results = run(args)
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+log = logging.getLogger("control")
+
+# Local Unix socket the scheduler listens on for commands from the API
+SOCKET_PATH = f"{os.getenv('HOME')}/smart_meter/scheduler.sock"
+
+class ControlServer:
+    """
+    Accepts one JSON command per line on a Unix socket and answers with
+    one JSON line. handlers maps an action name to a callable that takes
+    the remaining request fields as keyword arguments and returns a dict.
+    """
+
+    def __init__(self, handlers, socket_path=SOCKET_PATH):
+        self.handlers = handlers
+        self.socket_path = socket_path
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Bind the socket and serve commands on a background thread"""
+        # Remove a stale socket left behind by an unclean shutdown
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        handlers = self.handlers
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    response = dispatch(handlers, line)
+                    self.wfile.write(json.dumps(response).encode() + b'\n')
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self._server.daemon_threads = True
+        os.chmod(self.socket_path, 0o600)
+
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="control-server", daemon=True
+        )
+        self._thread.start()
+        log.info(f"Control socket listening on {self.socket_path}")
+
+    def stop(self):
+        """Stop serving and remove the socket"""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+def dispatch(handlers, line):
+    """Run one encoded command and return the response dict"""
+    try:
+        request = json.loads(line)
+        action = request.pop('action')
+        handler = handlers[action]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return {'success': False, 'error': f"Invalid command: {line[:200]!r}"}
+
+    try:
+        result = handler(**request) or {}
+        return {'success': True, **result}
+    except Exception as e:
+        log.error(f"Control command {action} failed: {e}")
+        return {'success': False, 'error': str(e)}
+
+def send_command(action, socket_path=SOCKET_PATH, timeout=2.0, **params):
+    """
+    Send a command to the scheduler and return its response dict.
+    Raises OSError if the scheduler is not reachable.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({'action': action, **params}).encode() + b'\n')
+
+        with sock.makefile('rb') as f:
+            line = f.readline()
+
+    if not line:
+        raise ConnectionError("Scheduler closed the control connection")
+    return json.loads(line)
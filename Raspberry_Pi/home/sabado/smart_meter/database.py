@@ -2,34 +2,194 @@
 
 import sqlite3
 import logging
-from datetime import datetime
+import queue
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
 from contextlib import contextmanager
+from instrumentation import counter, histogram
 
 log = logging.getLogger("database")
 
+DB_WRITE_SECONDS = histogram('smart_meter_db_write_seconds',
+                             'Duration of batch write transactions, commit included', ['table'])
+DB_ROWS_WRITTEN = counter('smart_meter_db_rows_written_total',
+                          'Rows handed to batch writes', ['table'])
+DB_ERRORS = counter('smart_meter_db_errors_total', 'Failed database transactions', ['kind'])
+
+# Connection tuning (see _configure)
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 8192
+
+# Timestamps are stored as naive UTC, same format as SQLite CURRENT_TIMESTAMP
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+RESET_PERIODS = ('daily', 'weekly', 'monthly')
+
+# Rollup resolutions kept in energy_rollups. Energy is published about once
+# a minute, so a minute rollup would be no smaller than the raw table.
+ROLLUP_RESOLUTIONS = ('hour', 'day')
+
+# Chart buckets served by get_aggregates, in seconds. 1h/1d come from the
+# rollups, 1w groups daily rollups into weeks (Monday start), 5m is
+# computed from raw readings.
+AGGREGATE_BUCKETS = {'5m': 300, '1h': 3600, '1d': 86400, '1w': 604800}
+
+def utc_now():
+    """Current time as naive UTC datetime"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def utc_timestamp():
+    """Current time formatted for the timestamp columns"""
+    return utc_now().strftime(TIMESTAMP_FORMAT)
+
+def timer_fire_at(duration_seconds):
+    """When a timer started now goes off, formatted for the fire_at column"""
+    return (utc_now() + timedelta(seconds=int(duration_seconds))).strftime(TIMESTAMP_FORMAT)
+
+def period_start(reset_period, when):
+    """Start of the daily/weekly/monthly period containing `when`"""
+    midnight = when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if reset_period == 'daily':
+        return midnight
+    elif reset_period == 'weekly':
+        return midnight - timedelta(days=midnight.weekday())
+    elif reset_period == 'monthly':
+        return midnight.replace(day=1)
+
+    raise ValueError(f"Unknown reset period: {reset_period}")
+
+def bucket_start(resolution, when):
+    """Start of the hour/day rollup bucket containing `when`"""
+    if resolution == 'hour':
+        return when.replace(minute=0, second=0, microsecond=0)
+    elif resolution == 'day':
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    raise ValueError(f"Unknown rollup resolution: {resolution}")
+
+class ConnectionPool:
+    """Keeps idle sqlite3 connections around so they can be reused"""
+
+    def __init__(self, connect, max_idle=4):
+        self._connect = connect
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def acquire(self):
+        """Return an idle connection, or open a new one if none is free"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        """Return a connection to the pool, closing it if the pool is full"""
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
 class Database:
-    def __init__(self, db_path):
+    def __init__(self, db_path, pooled=True, pool_size=4, readers=4, init=True):
+        """
+        pooled: reuse connections instead of opening one per call
+        pool_size / readers: idle writer / read-only connections kept open
+        init: create tables and run migrations (skip when another process,
+        e.g. gunicorn's schema init before starting workers, already did)
+        """
         self.db_path = db_path
-        self.init_database()
- 
+        self.pooled = pooled
+        self._writers = ConnectionPool(self._connect_writer, max_idle=pool_size)
+        self._readers = ConnectionPool(self._connect_reader, max_idle=readers)
+        if init:
+            self.init_database()
+
+    def _configure(self, conn):
+        """Per-connection pragmas shared by writers and readers"""
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KIB}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def _connect_writer(self):
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False)
+        self._configure(conn)
+        # Safe with WAL: only the last transactions can be lost on power cut,
+        # the database itself cannot be corrupted
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def _connect_reader(self):
+        uri = Path(self.db_path).resolve().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False)
+        self._configure(conn)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
     @contextmanager
     def get_connection(self):
         """Context manager for database connections"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        conn = self._writers.acquire() if self.pooled else self._connect_writer()
         try:
             yield conn
             conn.commit()
         except Exception as e:
             conn.rollback()
+            DB_ERRORS.inc(kind='write')
             log.error(f"Database error: {e}")
             raise
         finally:
-            conn.close()
+            if self.pooled:
+                self._writers.release(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def read_connection(self):
+        """
+        Context manager for read-only connections. With WAL journaling
+        readers never block on (or block) the ingest writer.
+        """
+        conn = self._readers.acquire() if self.pooled else self._connect_reader()
+        try:
+            yield conn
+        except Exception as e:
+            DB_ERRORS.inc(kind='read')
+            log.error(f"Database error: {e}")
+            raise
+        finally:
+            # End any open read transaction so the WAL can be checkpointed
+            conn.rollback()
+            if self.pooled:
+                self._readers.release(conn)
+            else:
+                conn.close()
+
+    def close(self):
+        """Close pooled connections"""
+        # SQLite checkpoints the WAL when the last connection closes, and a
+        # read-only connection can't, so the readers have to go first
+        self._readers.close()
+        self._writers.close()
 
     def init_database(self):
         """Create tables if they don't exist"""
         with self.get_connection() as conn:
+            # WAL is persistent in the database file, so this covers every
+            # process that opens scheduler.db afterwards
+            conn.execute('PRAGMA journal_mode = WAL')
+
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS schedules (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -74,52 +234,202 @@ class Database:
                 )
             ''')
 
+            # Running consumption per device and reset period, maintained on
+            # ingest so period lookups don't rescan energy_readings
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS consumption_totals (
+                    client_id TEXT NOT NULL,
+                    reset_period TEXT NOT NULL,
+                    period_start TIMESTAMP NOT NULL,
+                    consumption_kwh REAL NOT NULL DEFAULT 0,
+                    last_energy_kwh REAL NOT NULL,
+                    updated_at TIMESTAMP NOT NULL,
+                    PRIMARY KEY (client_id, reset_period, period_start)
+                )
+            ''')
+
+            # Hourly/daily downsampled readings, maintained on ingest and
+            # rebuilt from raw data by rebuild_rollups
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS energy_rollups (
+                    client_id TEXT NOT NULL,
+                    resolution TEXT NOT NULL,
+                    bucket_start TIMESTAMP NOT NULL,
+                    first_kwh REAL NOT NULL,
+                    last_kwh REAL NOT NULL,
+                    min_kwh REAL NOT NULL,
+                    max_kwh REAL NOT NULL,
+                    delta_kwh REAL NOT NULL DEFAULT 0,
+                    reading_count INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP NOT NULL,
+                    PRIMARY KEY (client_id, resolution, bucket_start)
+                )
+            ''')
+
+            # Voltage/current/power samples packed per device-hour (power_series.py)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS power_chunks (
+                    client_id TEXT NOT NULL,
+                    chunk_start INTEGER NOT NULL,
+                    sample_count INTEGER NOT NULL,
+                    samples BLOB NOT NULL,
+                    PRIMARY KEY (client_id, chunk_start)
+                )
+            ''')
+
+            # Device registry: latest known state of every device, maintained
+            # on ingest so listing devices never scans energy_readings
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS devices (
+                    client_id TEXT PRIMARY KEY,
+                    first_seen TIMESTAMP NOT NULL,
+                    last_seen TIMESTAMP,
+                    last_energy_kwh REAL,
+                    last_energy_at TIMESTAMP,
+                    status TEXT,
+                    status_at TIMESTAMP,
+                    relay_state INTEGER,
+                    relay_state_at TIMESTAMP
+                )
+            ''')
+
+            # Change counters per data scope ('schedules', 'thresholds',
+            # 'schedules:<client_id>', 'thresholds:<client_id>', 'devices',
+            # 'readings:<client_id>', 'power:<client_id>'), bumped
+            # in the same transaction as the write. The API uses them to
+            # validate cached responses.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS data_versions (
+                    scope TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )
+            ''')
+
+            # Absolute fire time of timers (UTC), so restarts don't extend them
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(schedules)')}
+            if 'fire_at' not in columns:
+                conn.execute('ALTER TABLE schedules ADD COLUMN fire_at TIMESTAMP')
+                conn.execute('''
+                    UPDATE schedules
+                    SET fire_at = datetime(created_at, '+' || duration_seconds || ' seconds')
+                    WHERE schedule_type = 'timer' AND duration_seconds IS NOT NULL
+                ''')
+
             # Create indexes
             conn.execute('CREATE INDEX IF NOT EXISTS idx_energy_client_time ON energy_readings(client_id, timestamp)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_schedules_client ON schedules(client_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_schedule_log_schedule ON schedule_log(schedule_id, action, executed_at)')
+
+            def is_empty(table):
+                return conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone() is None
+
+            has_readings = not is_empty('energy_readings')
+            backfill_totals = has_readings and is_empty('consumption_totals')
+            backfill_rollups = has_readings and is_empty('energy_rollups')
+
+            if has_readings and is_empty('devices'):
+                self._backfill_devices(conn)
+
+        # One-off migration for databases created before these tables existed
+        if backfill_totals:
+            self.backfill_consumption_totals()
+        if backfill_rollups:
+            self.rebuild_rollups()
 
         log.info("Database initialized")
 
+    def _backfill_devices(self, conn):
+        """Populate devices from energy_readings (one-off migration)"""
+        conn.execute('''
+            INSERT INTO devices (client_id, first_seen, last_seen, last_energy_kwh, last_energy_at)
+            SELECT latest.client_id, oldest.first_seen, latest.timestamp,
+                   latest.energy_kwh, latest.timestamp
+            FROM (
+                -- SQLite returns energy_kwh from the row holding MAX(timestamp)
+                SELECT client_id, MAX(timestamp) AS timestamp, energy_kwh
+                FROM energy_readings GROUP BY client_id
+            ) AS latest
+            JOIN (
+                SELECT client_id, MIN(timestamp) AS first_seen
+                FROM energy_readings GROUP BY client_id
+            ) AS oldest USING (client_id)
+        ''')
+        log.info("Backfilled device registry from energy readings")
+
+    def _bump_versions(self, conn, scopes):
+        """Increment the data_versions counters of scopes (inside a write)"""
+        conn.executemany('''
+            INSERT INTO data_versions (scope, version) VALUES (?, 1)
+            ON CONFLICT(scope) DO UPDATE SET version = version + 1
+        ''', [(scope,) for scope in scopes])
+
+    def get_versions(self, scopes):
+        """Current data_versions counters for scopes, in order (0 if never written)"""
+        with self.read_connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT scope, version FROM data_versions
+                WHERE scope IN ({', '.join('?' * len(scopes))})
+            ''', list(scopes))
+            versions = dict(cursor.fetchall())
+        return tuple(versions.get(scope, 0) for scope in scopes)
+
     def get_all_schedules(self, enabled=None):
         """Get all schedules, optionally filtered by enabled status"""
-        with self.get_connection() as conn:
+        with self.read_connection() as conn:
             if enabled is not None:
                 cursor = conn.execute('SELECT * FROM schedules WHERE enabled = ?', (enabled,))
             else:
                 cursor = conn.execute('SELECT * FROM schedules')
             return [dict(row) for row in cursor.fetchall()]
 
+    def get_schedules_for_device(self, client_id):
+        """Schedules of one device (idx_schedules_client)"""
+        with self.read_connection() as conn:
+            cursor = conn.execute('SELECT * FROM schedules WHERE client_id = ? ORDER BY id',
+                                  (client_id,))
+            return [dict(row) for row in cursor.fetchall()]
+
     def get_schedule(self, schedule_id):
         """Get single schedule by ID"""
-        with self.get_connection() as conn:
+        with self.read_connection() as conn:
             cursor = conn.execute('SELECT * FROM schedules WHERE id = ?', (schedule_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
 
     def add_schedule(self, client_id, schedule_type, **kwargs):
-        """Add new schedule"""
+        """Add new schedule (timers start counting down now)"""
+        fire_at = None
+        if schedule_type == 'timer' and kwargs.get('duration_seconds') is not None:
+            fire_at = timer_fire_at(kwargs['duration_seconds'])
+
         with self.get_connection() as conn:
             cursor = conn.execute('''
                 INSERT INTO schedules (client_id, schedule_type, start_time, end_time, 
-                                     duration_seconds, days_of_week)
-                VALUES (?, ?, ?, ?, ?, ?)
+                                     duration_seconds, days_of_week, fire_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (
                 client_id,
                 schedule_type,
                 kwargs.get('start_time'),
                 kwargs.get('end_time'),
                 kwargs.get('duration_seconds'),
-                kwargs.get('days_of_week')
+                kwargs.get('days_of_week'),
+                fire_at
             ))
+            self._bump_versions(conn, ['schedules', f"schedules:{client_id}"])
             return cursor.lastrowid
 
     def delete_schedule(self, schedule_id):
         """Delete schedule"""
         with self.get_connection() as conn:
+            row = conn.execute('SELECT client_id FROM schedules WHERE id = ?',
+                               (schedule_id,)).fetchone()
             conn.execute('DELETE FROM schedules WHERE id = ?', (schedule_id,))
+            if row:
+                self._bump_versions(conn, ['schedules', f"schedules:{row['client_id']}"])
 
     def update_schedule(self, schedule_id, **kwargs):
-        """Update schedule fields"""
+        """Update schedule fields (a new timer duration restarts the timer now)"""
         with self.get_connection() as conn:
             # Build UPDATE query dynamically based on provided kwargs
             fields = []
@@ -133,19 +443,36 @@ class Database:
             if not fields:
                 return  # Nothing to update
 
+            row = conn.execute('SELECT client_id, schedule_type FROM schedules WHERE id = ?',
+                               (schedule_id,)).fetchone()
+            if not row:
+                return
+
+            if row['schedule_type'] == 'timer' and kwargs.get('duration_seconds') is not None:
+                fields.append("fire_at = ?")
+                values.append(timer_fire_at(kwargs['duration_seconds']))
+
             values.append(schedule_id)
             query = f"UPDATE schedules SET {', '.join(fields)} WHERE id = ?"
             conn.execute(query, values)
+            self._bump_versions(conn, ['schedules', f"schedules:{row['client_id']}"])
 
     def get_all_thresholds(self, enabled=None):
         """Get all thresholds"""
-        with self.get_connection() as conn:
+        with self.read_connection() as conn:
             if enabled is not None:
                 cursor = conn.execute('SELECT * FROM thresholds WHERE enabled = ?', (enabled,))
             else:
                 cursor = conn.execute('SELECT * FROM thresholds')
             return [dict(row) for row in cursor.fetchall()]
 
+    def get_threshold(self, client_id):
+        """Get threshold for a device (unique client_id index)"""
+        with self.read_connection() as conn:
+            cursor = conn.execute('SELECT * FROM thresholds WHERE client_id = ?', (client_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
     def set_threshold(self, client_id, limit_kwh, reset_period):
         """Set or update threshold for device"""
         with self.get_connection() as conn:
@@ -157,29 +484,579 @@ class Database:
                     reset_period = excluded.reset_period,
                     enabled = 1
             ''', (client_id, limit_kwh, reset_period))
+            self._bump_versions(conn, ['thresholds', f"thresholds:{client_id}"])
 
     def disable_threshold(self, threshold_id):
         """Disable threshold after triggering"""
         with self.get_connection() as conn:
+            row = conn.execute('SELECT client_id FROM thresholds WHERE id = ?',
+                               (threshold_id,)).fetchone()
             conn.execute('UPDATE thresholds SET enabled = 0 WHERE id = ?', (threshold_id,))
+            if row:
+                self._bump_versions(conn, ['thresholds', f"thresholds:{row['client_id']}"])
+
+    def delete_threshold(self, client_id):
+        """Delete a device's threshold; returns False if it had none"""
+        with self.get_connection() as conn:
+            cursor = conn.execute('DELETE FROM thresholds WHERE client_id = ?', (client_id,))
+            self._bump_versions(conn, ['thresholds', f"thresholds:{client_id}"])
+            return cursor.rowcount > 0
 
     def store_energy_reading(self, client_id, energy_kwh):
         """Store energy reading"""
+        self.store_energy_readings([(client_id, energy_kwh, utc_timestamp())])
+
+    def store_energy_readings(self, readings):
+        """
+        Store a batch of energy readings in a single transaction
+        readings: iterable of (client_id, energy_kwh, timestamp) tuples,
+        timestamp formatted as 'YYYY-MM-DD HH:MM:SS' (UTC)
+        """
+        readings = list(readings)
+
+        # Derived rows are built before the transaction: the write lock is
+        # taken at the first INSERT, so other writers (e.g. ingest shards)
+        # only wait for the statements themselves
+        totals = self._consumption_total_rows(readings)
+        rollups = self._rollup_rows(readings)
+
+        with DB_WRITE_SECONDS.time(table='energy_readings'), self.get_connection() as conn:
+            conn.executemany('''
+                INSERT INTO energy_readings (client_id, energy_kwh, timestamp)
+                VALUES (?, ?, ?)
+            ''', readings)
+            self._update_consumption_totals(conn, totals)
+            self._update_rollups(conn, rollups)
+            self._update_device_energy(conn, readings)
+            self._bump_versions(conn, ['devices'] + sorted(
+                {f"readings:{client_id}" for client_id, _, _ in readings}))
+        DB_ROWS_WRITTEN.inc(len(readings), table='energy_readings')
+
+    def _consumption_total_rows(self, readings):
+        """consumption_totals rows of a batch (one per reading and reset period)"""
+        # Readings of a batch mostly share a few timestamps (second resolution)
+        starts = {}
+        rows = []
+        for client_id, energy_kwh, timestamp in readings:
+            if timestamp not in starts:
+                when = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+                starts[timestamp] = [(reset_period, period_start(reset_period, when).strftime(TIMESTAMP_FORMAT))
+                                     for reset_period in RESET_PERIODS]
+            for reset_period, start in starts[timestamp]:
+                rows.append((client_id, reset_period, start, energy_kwh, timestamp))
+        return rows
+
+    def _update_consumption_totals(self, conn, rows):
+        """
+        Fold readings into consumption_totals. Mirrors get_consumption_since:
+        only positive deltas between readings of the same period count, so
+        meter resets are skipped. Readings older than the period's latest
+        one are ignored.
+        """
+        conn.executemany('''
+            INSERT INTO consumption_totals (client_id, reset_period, period_start,
+                                            consumption_kwh, last_energy_kwh, updated_at)
+            VALUES (?, ?, ?, 0, ?, ?)
+            ON CONFLICT(client_id, reset_period, period_start) DO UPDATE SET
+                consumption_kwh = consumption_kwh + MAX(excluded.last_energy_kwh - last_energy_kwh, 0),
+                last_energy_kwh = excluded.last_energy_kwh,
+                updated_at = excluded.updated_at
+            WHERE excluded.updated_at >= consumption_totals.updated_at
+        ''', rows)
+
+    def _update_device_energy(self, conn, readings):
+        """Record each device's latest reading in the registry"""
+        conn.executemany('''
+            INSERT INTO devices (client_id, first_seen, last_seen, last_energy_kwh, last_energy_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(client_id) DO UPDATE SET
+                last_seen = MAX(COALESCE(last_seen, ''), excluded.last_seen),
+                last_energy_kwh = excluded.last_energy_kwh,
+                last_energy_at = excluded.last_energy_at
+            WHERE excluded.last_energy_at >= COALESCE(devices.last_energy_at, '')
+        ''', [(client_id, timestamp, timestamp, energy_kwh, timestamp)
+              for client_id, energy_kwh, timestamp in readings])
+
+    def update_devices(self, events):
+        """
+        Apply a batch of device events in one transaction
+        events: iterable of (client_id, field, value, timestamp, live) where
+        field is 'status', 'relay_state' or None (heartbeat) and live is
+        False for retained messages replayed by the broker, which update
+        state but don't count as the device being seen
+        """
+        events = list(events)
+        with DB_WRITE_SECONDS.time(table='devices'), self.get_connection() as conn:
+            for client_id, field, value, timestamp, live in events:
+                conn.execute('''
+                    INSERT INTO devices (client_id, first_seen) VALUES (?, ?)
+                    ON CONFLICT(client_id) DO NOTHING
+                ''', (client_id, timestamp))
+
+                if field in ('status', 'relay_state'):
+                    conn.execute(f'''
+                        UPDATE devices SET {field} = ?, {field}_at = ?
+                        WHERE client_id = ? AND COALESCE({field}_at, '') <= ?
+                    ''', (value, timestamp, client_id, timestamp))
+
+                if live:
+                    conn.execute('''
+                        UPDATE devices SET last_seen = MAX(COALESCE(last_seen, ''), ?)
+                        WHERE client_id = ?
+                    ''', (timestamp, client_id))
+
+            self._bump_versions(conn, ['devices'])
+        DB_ROWS_WRITTEN.inc(len(events), table='devices')
+
+    def get_devices(self):
+        """All registered devices, most recently seen first"""
+        with self.read_connection() as conn:
+            cursor = conn.execute('''
+                SELECT * FROM devices
+                ORDER BY COALESCE(last_seen, first_seen) DESC
+            ''')
+            return [dict(row) for row in cursor.fetchall()]
+
+    def get_period_consumption(self, client_id, reset_period, now=None):
+        """
+        Consumption in the current daily/weekly/monthly period (UTC),
+        read from consumption_totals
+        """
+        start = period_start(reset_period, now or utc_now())
+        with self.read_connection() as conn:
+            row = conn.execute('''
+                SELECT consumption_kwh FROM consumption_totals
+                WHERE client_id = ? AND reset_period = ? AND period_start = ?
+            ''', (client_id, reset_period, start.strftime(TIMESTAMP_FORMAT))).fetchone()
+            return row['consumption_kwh'] if row else 0.0
+
+    def get_fleet_summary(self, reset_period, client_ids=None, now=None):
+        """
+        One row per registered device (optionally only client_ids) with
+        its registry fields, consumption in the current reset_period, and
+        its threshold plus the consumption in the threshold's own period.
+        Served by a single query over devices, consumption_totals and
+        thresholds.
+        """
+        now = now or utc_now()
+        starts = {period: period_start(period, now).strftime(TIMESTAMP_FORMAT)
+                  for period in RESET_PERIODS}
+
+        params = [reset_period, starts[reset_period],
+                  starts['daily'], starts['weekly'], starts['monthly']]
+        where = ''
+        if client_ids is not None:
+            where = f"WHERE d.client_id IN ({', '.join('?' * len(client_ids))})"
+            params.extend(client_ids)
+
+        with self.read_connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT d.*,
+                       COALESCE(c.consumption_kwh, 0) AS consumption_kwh,
+                       t.limit_kwh, t.reset_period AS threshold_period,
+                       t.enabled AS threshold_enabled,
+                       COALESCE(tc.consumption_kwh, 0) AS threshold_consumption_kwh
+                FROM devices d
+                LEFT JOIN consumption_totals c
+                       ON c.client_id = d.client_id
+                      AND c.reset_period = ? AND c.period_start = ?
+                LEFT JOIN thresholds t ON t.client_id = d.client_id
+                LEFT JOIN consumption_totals tc
+                       ON tc.client_id = d.client_id
+                      AND tc.reset_period = t.reset_period
+                      AND tc.period_start = CASE t.reset_period
+                              WHEN 'daily' THEN ? WHEN 'weekly' THEN ? WHEN 'monthly' THEN ? END
+                {where}
+                ORDER BY COALESCE(d.last_seen, d.first_seen) DESC
+            ''', params)
+            return [dict(row) for row in cursor.fetchall()]
+
+    def backfill_consumption_totals(self, since=None):
+        """
+        Rebuild consumption_totals from energy_readings for every period
+        starting at or after `since` (default: the current week and month)
+        """
+        if since is None:
+            now = utc_now()
+            since = min(period_start('weekly', now), period_start('monthly', now))
+
+        since = period_start('daily', since)
+        since_str = since.strftime(TIMESTAMP_FORMAT)
+        log.info(f"Backfilling consumption totals since {since_str}")
+
+        totals = {}
+        with self.read_connection() as conn:
+            cursor = conn.execute('''
+                SELECT client_id, energy_kwh, timestamp
+                FROM energy_readings
+                WHERE timestamp >= ?
+                ORDER BY client_id, timestamp, id
+            ''', (since_str,))
+
+            for row in cursor:
+                when = datetime.strptime(row['timestamp'], TIMESTAMP_FORMAT)
+                for reset_period in RESET_PERIODS:
+                    start = period_start(reset_period, when)
+                    if start < since:
+                        continue  # partial period, can't be rebuilt exactly
+
+                    key = (row['client_id'], reset_period, start.strftime(TIMESTAMP_FORMAT))
+                    total = totals.get(key)
+                    if total is None:
+                        totals[key] = [0.0, row['energy_kwh'], row['timestamp']]
+                        continue
+
+                    delta = row['energy_kwh'] - total[1]
+                    if delta > 0:
+                        total[0] += delta
+                    total[1] = row['energy_kwh']
+                    total[2] = row['timestamp']
+
         with self.get_connection() as conn:
-            conn.execute('''
-                INSERT INTO energy_readings (client_id, energy_kwh)
-                VALUES (?, ?)
-            ''', (client_id, energy_kwh))
+            conn.execute('DELETE FROM consumption_totals WHERE period_start >= ?', (since_str,))
+            conn.executemany('''
+                INSERT INTO consumption_totals (client_id, reset_period, period_start,
+                                                consumption_kwh, last_energy_kwh, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [key + tuple(total) for key, total in totals.items()])
+            self._bump_versions(conn, ['devices'] + sorted(
+                {f"readings:{key[0]}" for key in totals}))
 
-    def get_consumption_since(self, client_id, start_time):
-        """Get energy consumption since timestamp, handling meter resets"""
+        log.info(f"Backfilled {len(totals)} consumption total(s)")
+
+    def _rollup_rows(self, readings):
+        """energy_rollups rows of a batch (one per reading and resolution)"""
+        starts = {}
+        rows = []
+        for client_id, energy_kwh, timestamp in readings:
+            if timestamp not in starts:
+                when = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+                starts[timestamp] = [(resolution, bucket_start(resolution, when).strftime(TIMESTAMP_FORMAT))
+                                     for resolution in ROLLUP_RESOLUTIONS]
+            for resolution, start in starts[timestamp]:
+                rows.append((client_id, resolution, start, energy_kwh, energy_kwh,
+                             energy_kwh, energy_kwh, timestamp))
+        return rows
+
+    def _update_rollups(self, conn, rows):
+        """
+        Fold readings into energy_rollups. delta_kwh only covers deltas
+        inside a bucket; get_rollups adds the step from the previous bucket.
+        """
+        conn.executemany('''
+            INSERT INTO energy_rollups (client_id, resolution, bucket_start, first_kwh, last_kwh,
+                                        min_kwh, max_kwh, delta_kwh, reading_count, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0, 1, ?)
+            ON CONFLICT(client_id, resolution, bucket_start) DO UPDATE SET
+                delta_kwh = delta_kwh + MAX(excluded.last_kwh - last_kwh, 0),
+                last_kwh = excluded.last_kwh,
+                min_kwh = MIN(min_kwh, excluded.min_kwh),
+                max_kwh = MAX(max_kwh, excluded.max_kwh),
+                reading_count = reading_count + 1,
+                updated_at = excluded.updated_at
+            WHERE excluded.updated_at >= energy_rollups.updated_at
+        ''', rows)
+
+    def rebuild_rollups(self, since=None, until=None):
+        """
+        Recompute energy_rollups from energy_readings for buckets starting
+        in [since, until). since defaults to the oldest raw reading (older
+        buckets were archived and are kept), until to unbounded. Only
+        rebuild closed buckets while ingest is running, or readings that
+        arrive during the rebuild are lost from the rollup.
+        """
+        if since is None:
+            with self.read_connection() as conn:
+                oldest = conn.execute('SELECT MIN(timestamp) FROM energy_readings').fetchone()[0]
+            if oldest is None:
+                return
+            since = datetime.strptime(oldest, TIMESTAMP_FORMAT)
+
+        bounds = ['{column} >= ?']
+        params = [bucket_start('day', since).strftime(TIMESTAMP_FORMAT)]
+        if until is not None:
+            bounds.append('{column} < ?')
+            params.append(bucket_start('day', until).strftime(TIMESTAMP_FORMAT))
+
+        def where(column):
+            return 'WHERE ' + ' AND '.join(b.format(column=column) for b in bounds)
+
+        log.info(f"Rebuilding rollups ({where('timestamp')})")
+
+        buckets = {}
+        with self.read_connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT client_id, energy_kwh, timestamp
+                FROM energy_readings
+                {where('timestamp')}
+                ORDER BY client_id, timestamp, id
+            ''', params)
+
+            for row in cursor:
+                when = datetime.strptime(row['timestamp'], TIMESTAMP_FORMAT)
+                energy_kwh = row['energy_kwh']
+                for resolution in ROLLUP_RESOLUTIONS:
+                    key = (row['client_id'], resolution,
+                           bucket_start(resolution, when).strftime(TIMESTAMP_FORMAT))
+                    bucket = buckets.get(key)
+                    if bucket is None:
+                        # first, last, min, max, delta, count, updated_at
+                        buckets[key] = [energy_kwh, energy_kwh, energy_kwh, energy_kwh,
+                                        0.0, 1, row['timestamp']]
+                        continue
+
+                    delta = energy_kwh - bucket[1]
+                    if delta > 0:
+                        bucket[4] += delta
+                    bucket[1] = energy_kwh
+                    bucket[2] = min(bucket[2], energy_kwh)
+                    bucket[3] = max(bucket[3], energy_kwh)
+                    bucket[5] += 1
+                    bucket[6] = row['timestamp']
+
+        with self.get_connection() as conn:
+            conn.execute(f"DELETE FROM energy_rollups {where('bucket_start')}", params)
+            conn.executemany('''
+                INSERT INTO energy_rollups (client_id, resolution, bucket_start, first_kwh, last_kwh,
+                                            min_kwh, max_kwh, delta_kwh, reading_count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [key + tuple(bucket) for key, bucket in buckets.items()])
+            self._bump_versions(conn, sorted({f"readings:{key[0]}" for key in buckets}))
+
+        log.info(f"Rebuilt {len(buckets)} rollup bucket(s)")
+
+    def get_rollups(self, client_id, resolution, start, end):
+        """
+        Hourly/daily rollups for a device between two datetimes (the bucket
+        containing `start` is included). consumption_kwh is reset-aware and
+        includes the step from the previous bucket's last reading.
+        """
+        with self.read_connection() as conn:
+            cursor = conn.execute('''
+                SELECT bucket_start, first_kwh, last_kwh, min_kwh, max_kwh,
+                       delta_kwh, reading_count
+                FROM energy_rollups
+                WHERE client_id = ? AND resolution = ?
+                  AND bucket_start >= ? AND bucket_start <= ?
+                ORDER BY bucket_start ASC
+            ''', (client_id, resolution,
+                  bucket_start(resolution, start).strftime(TIMESTAMP_FORMAT),
+                  end.strftime(TIMESTAMP_FORMAT)))
+
+            rollups = []
+            prev_last = None
+            for row in cursor:
+                consumption = row['delta_kwh']
+                if prev_last is not None and row['first_kwh'] > prev_last:
+                    consumption += row['first_kwh'] - prev_last
+                prev_last = row['last_kwh']
+
+                rollups.append({
+                    'timestamp': row['bucket_start'],
+                    'energy_kwh': row['last_kwh'],
+                    'min_kwh': row['min_kwh'],
+                    'max_kwh': row['max_kwh'],
+                    'consumption_kwh': round(consumption, 3),
+                    'reading_count': row['reading_count']
+                })
+            return rollups
+
+    def iter_readings(self, client_id, start=None, end=None, after=None,
+                      limit=None, batch_size=500):
+        """
+        Yield raw readings (id, energy_kwh, timestamp rows) for a device in
+        (timestamp, id) order, fetching batch_size rows at a time.
+        after=(timestamp, id) starts just past that key (keyset pagination).
+        The read connection is held until the generator is exhausted or closed.
+        """
+        clauses = ['client_id = ?']
+        params = [client_id]
+        if start:
+            clauses.append('timestamp >= ?')
+            params.append(start)
+        if end:
+            clauses.append('timestamp <= ?')
+            params.append(end)
+        if after:
+            clauses.append('(timestamp, id) > (?, ?)')
+            params.extend(after)
+
+        sql = f'''
+            SELECT id, energy_kwh, timestamp FROM energy_readings
+            WHERE {' AND '.join(clauses)}
+            ORDER BY timestamp ASC, id ASC
+        '''
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        with self.read_connection() as conn:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+
+    def get_aggregates(self, client_id, bucket, start, end):
+        """
+        Energy per chart bucket (a key of AGGREGATE_BUCKETS) between two
+        datetimes, with the same fields as get_rollups
+        """
+        if bucket == '1h':
+            return self.get_rollups(client_id, 'hour', start, end)
+        elif bucket == '1d':
+            return self.get_rollups(client_id, 'day', start, end)
+        elif bucket == '1w':
+            rollups = self.get_rollups(client_id, 'day', period_start('weekly', start), end)
+            return self._group_by_week(rollups)
+        elif bucket == '5m':
+            return self._raw_buckets(client_id, AGGREGATE_BUCKETS[bucket], start, end)
+
+        raise ValueError(f"Unknown aggregate bucket: {bucket}")
+
+    def _group_by_week(self, rollups):
+        """Merge daily rollups (oldest first) into Monday-start weeks"""
+        weeks = []
+        current = None
+        for rollup in rollups:
+            day = datetime.strptime(rollup['timestamp'], TIMESTAMP_FORMAT)
+            week = period_start('weekly', day).strftime(TIMESTAMP_FORMAT)
+            if current is None or current['timestamp'] != week:
+                current = dict(rollup, timestamp=week)
+                weeks.append(current)
+                continue
+
+            current['energy_kwh'] = rollup['energy_kwh']
+            current['min_kwh'] = min(current['min_kwh'], rollup['min_kwh'])
+            current['max_kwh'] = max(current['max_kwh'], rollup['max_kwh'])
+            current['consumption_kwh'] = round(current['consumption_kwh'] + rollup['consumption_kwh'], 3)
+            current['reading_count'] += rollup['reading_count']
+        return weeks
+
+    def _raw_buckets(self, client_id, seconds, start, end):
+        """
+        Fixed-size buckets computed from raw readings in one ordered pass.
+        Consumption only counts increases (a drop is a meter reset) and
+        includes the step from the last reading before the first bucket.
+        Archived readings are not included.
+        """
+        epoch = int(start.replace(tzinfo=timezone.utc).timestamp())
+        first = start - timedelta(seconds=epoch % seconds, microseconds=start.microsecond)
+
+        with self.read_connection() as conn:
+            row = conn.execute('''
+                SELECT energy_kwh FROM energy_readings
+                WHERE client_id = ? AND timestamp < ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT 1
+            ''', (client_id, first.strftime(TIMESTAMP_FORMAT))).fetchone()
+            prev = row['energy_kwh'] if row else None
+
+            cursor = conn.execute('''
+                SELECT energy_kwh, timestamp FROM energy_readings
+                WHERE client_id = ? AND timestamp >= ? AND timestamp <= ?
+                ORDER BY timestamp ASC, id ASC
+            ''', (client_id, first.strftime(TIMESTAMP_FORMAT), end.strftime(TIMESTAMP_FORMAT)))
+
+            buckets = []
+            current = None
+            current_end = None
+            for row in cursor:
+                energy_kwh = row['energy_kwh']
+                delta = energy_kwh - prev if prev is not None and energy_kwh > prev else 0.0
+                prev = energy_kwh
+
+                # Timestamps compare correctly as strings; only parse on a new bucket
+                if current is None or row['timestamp'] >= current_end:
+                    when = datetime.strptime(row['timestamp'], TIMESTAMP_FORMAT)
+                    bucket = when - timedelta(seconds=(when - first).total_seconds() % seconds)
+                    current_end = (bucket + timedelta(seconds=seconds)).strftime(TIMESTAMP_FORMAT)
+                    current = {
+                        'timestamp': bucket.strftime(TIMESTAMP_FORMAT),
+                        'energy_kwh': energy_kwh,
+                        'min_kwh': energy_kwh,
+                        'max_kwh': energy_kwh,
+                        'consumption_kwh': delta,
+                        'reading_count': 1
+                    }
+                    buckets.append(current)
+                    continue
+
+                current['energy_kwh'] = energy_kwh
+                current['min_kwh'] = min(current['min_kwh'], energy_kwh)
+                current['max_kwh'] = max(current['max_kwh'], energy_kwh)
+                current['consumption_kwh'] += delta
+                current['reading_count'] += 1
+
+        for bucket in buckets:
+            bucket['consumption_kwh'] = round(bucket['consumption_kwh'], 3)
+        return buckets
+
+    def append_power_chunks(self, chunks):
+        """
+        Append packed power samples in one transaction
+        chunks: iterable of (client_id, chunk_start, sample_count, samples_blob)
+        """
+        chunks = list(chunks)
+        with DB_WRITE_SECONDS.time(table='power_chunks'), self.get_connection() as conn:
+            conn.executemany('''
+                INSERT INTO power_chunks (client_id, chunk_start, sample_count, samples)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(client_id, chunk_start) DO UPDATE SET
+                    sample_count = sample_count + excluded.sample_count,
+                    samples = CAST(samples || excluded.samples AS BLOB)
+            ''', chunks)
+            self._bump_versions(conn, sorted({f"power:{chunk[0]}" for chunk in chunks}))
+        DB_ROWS_WRITTEN.inc(len(chunks), table='power_chunks')
+
+    def get_power_chunks(self, client_id, start, end):
+        """(chunk_start, samples_blob) for chunks starting in [start, end] (unix seconds)"""
+        with self.read_connection() as conn:
+            cursor = conn.execute('''
+                SELECT chunk_start, samples FROM power_chunks
+                WHERE client_id = ? AND chunk_start >= ? AND chunk_start <= ?
+                ORDER BY chunk_start ASC
+            ''', (client_id, start, end))
+            return [(row['chunk_start'], row['samples']) for row in cursor.fetchall()]
+
+    def get_readings_before(self, cutoff, limit):
+        """Oldest readings with timestamp < cutoff, as (id, client_id, energy_kwh, timestamp)"""
+        with self.read_connection() as conn:
+            cursor = conn.execute('''
+                SELECT id, client_id, energy_kwh, timestamp
+                FROM energy_readings
+                WHERE timestamp < ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (cutoff, limit))
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def delete_readings_before(self, cutoff, max_id):
+        """Delete readings with timestamp < cutoff and id <= max_id (one get_readings_before chunk)"""
         with self.get_connection() as conn:
+            # The rows move to the archive: cached range responses of these
+            # devices are stale
+            client_ids = [row[0] for row in conn.execute(
+                'SELECT DISTINCT client_id FROM energy_readings WHERE id <= ? AND timestamp < ?',
+                (max_id, cutoff))]
+            conn.execute('DELETE FROM energy_readings WHERE id <= ? AND timestamp < ?',
+                         (max_id, cutoff))
+            self._bump_versions(conn, sorted(f"readings:{client_id}" for client_id in client_ids))
+
+    def get_consumption_since(self, client_id, start_time):
+        """
+        Get energy consumption since timestamp, handling meter resets.
+        Scans energy_readings; use get_period_consumption for the current
+        period and keep this for arbitrary start times and verification.
+        """
+        with self.read_connection() as conn:
             cursor = conn.execute('''
                 SELECT energy_kwh, timestamp 
                 FROM energy_readings 
                 WHERE client_id = ? AND timestamp >= ?
                 ORDER BY timestamp ASC
-            ''', (client_id, start_time.strftime('%Y-%m-%d %H:%M:%S')))
+            ''', (client_id, start_time.strftime(TIMESTAMP_FORMAT)))
             
             readings = cursor.fetchall()
             
@@ -202,10 +1079,24 @@ class Database:
             
             return total_consumption
 
+    def get_last_executions(self):
+        """{(schedule_id, action): latest executed_at} from schedule_log"""
+        with self.read_connection() as conn:
+            cursor = conn.execute('''
+                SELECT schedule_id, action, MAX(executed_at) AS executed_at
+                FROM schedule_log GROUP BY schedule_id, action
+            ''')
+            return {(row['schedule_id'], row['action']): row['executed_at']
+                    for row in cursor.fetchall()}
+
     def log_schedule_execution(self, schedule_id, action):
         """Log schedule execution"""
+        self.log_schedule_executions([(schedule_id, action)])
+
+    def log_schedule_executions(self, executions):
+        """Log a batch of (schedule_id, action) executions in one transaction"""
         with self.get_connection() as conn:
-            conn.execute('''
+            conn.executemany('''
                 INSERT INTO schedule_log (schedule_id, action)
                 VALUES (?, ?)
-            ''', (schedule_id, action))
+            ''', executions)
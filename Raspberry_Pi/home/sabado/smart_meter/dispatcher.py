@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from collections import deque
+from apscheduler.triggers.cron import CronTrigger
+from database import utc_timestamp
+from instrumentation import counter, histogram
+
+log = logging.getLogger("dispatcher")
+
+RELAY_COMMANDS = {'ON': 'RELAY_ON', 'OFF': 'RELAY_OFF'}
+
+DISPATCH_COMMANDS = counter('smart_meter_dispatch_commands_total',
+                            'Relay commands sent by grouped schedule jobs, by broker delivery outcome',
+                            ['action', 'outcome'])
+DISPATCH_SECONDS = histogram('smart_meter_dispatch_seconds',
+                             'Time to publish and log one group of schedule transitions')
+
+def summarize(client_ids, limit=10):
+    """Comma-separated IDs for a log line, truncated for large fleets"""
+    if not client_ids:
+        return '-'
+    more = f" (+{len(client_ids) - limit} more)" if len(client_ids) > limit else ''
+    return ', '.join(client_ids[:limit]) + more
+
+def group_job_id(key):
+    action, hour, minute, days = key
+    return f"dispatch_{action.lower()}_{hour:02d}{minute:02d}_{days or 'all'}"
+
+class RelayDispatcher:
+    """
+    Runs daily schedule transitions that share a trigger (action, time,
+    days of week) as one cron job instead of one job per schedule. When
+    the job fires, every member's relay command is published in a burst,
+    schedule_log is written in a single transaction, and then the broker's
+    acknowledgement of each (QoS 1) command is awaited for up to
+    ack_timeout seconds. The outcome of the latest dispatches is kept for
+    status queries. With a tracker (RelayAckTracker) every command is
+    also followed until the device confirms it.
+    """
+
+    def __init__(self, scheduler, mqtt, db, ack_timeout=5.0, history=50, tracker=None):
+        self.scheduler = scheduler
+        self.mqtt = mqtt
+        self.db = db
+        self.ack_timeout = ack_timeout
+        self.tracker = tracker
+
+        # (action, hour, minute, days) -> {schedule_id: client_id}
+        self.groups = {}
+        # schedule_id -> keys of the groups it belongs to
+        self.memberships = {}
+        self.recent = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def add(self, schedule_id, client_id, action, hour, minute, days=None):
+        """Add one transition of a schedule, creating its group's job if needed"""
+        if days:
+            days = ','.join(sorted(day.strip().lower() for day in days.split(',')))
+        key = (action, hour, minute, days or None)
+
+        with self._lock:
+            members = self.groups.get(key)
+            if members is None:
+                members = self.groups[key] = {}
+                self.scheduler.add_job(
+                    self.dispatch,
+                    trigger=CronTrigger(hour=hour, minute=minute, day_of_week=key[3]),
+                    args=[key],
+                    id=group_job_id(key),
+                    replace_existing=True
+                )
+            members[schedule_id] = client_id
+            self.memberships.setdefault(schedule_id, []).append(key)
+
+    def remove(self, schedule_id):
+        """Remove a schedule from its groups; returns the number of transitions removed"""
+        with self._lock:
+            keys = self.memberships.pop(schedule_id, [])
+            for key in keys:
+                members = self.groups.get(key, {})
+                members.pop(schedule_id, None)
+                if not members:
+                    self.groups.pop(key, None)
+                    if self.scheduler.get_job(group_job_id(key)):
+                        self.scheduler.remove_job(group_job_id(key))
+            return len(keys)
+
+    def transitions(self, schedule_id):
+        """(action, job) for each transition of a schedule"""
+        with self._lock:
+            keys = list(self.memberships.get(schedule_id, []))
+        return [(key[0], self.scheduler.get_job(group_job_id(key))) for key in keys]
+
+    def dispatch(self, key):
+        """Job function: send the group's commands and record the outcome"""
+        action = key[0]
+        with self._lock:
+            members = list(self.groups.get(key, {}).items())
+        if not members:
+            return
+
+        started = time.monotonic()
+
+        # A device in the group through several schedules gets one command
+        client_ids = list(dict.fromkeys(client_id for _, client_id in members))
+        command = RELAY_COMMANDS[action]
+
+        # Tracked before the burst so an early state report counts as the ack
+        if self.tracker:
+            self.tracker.track_many(client_ids, command, 'schedule')
+        try:
+            infos = self.mqtt.publish_relay_commands(client_ids, command)
+        except Exception:
+            if self.tracker:
+                for client_id in client_ids:
+                    self.tracker.discard(client_id, command)
+            raise
+        published = time.monotonic()
+
+        try:
+            self.db.log_schedule_executions([(schedule_id, action) for schedule_id, _ in members])
+        except Exception as e:
+            log.error(f"{group_job_id(key)}: failed to log {len(members)} execution(s): {e}")
+        DISPATCH_SECONDS.observe(time.monotonic() - started)
+
+        delivered, pending, failed = self.mqtt.wait_for_delivery(infos, self.ack_timeout)
+        if self.tracker:
+            # Rejected outright, so no state report will ever confirm them
+            for client_id in failed:
+                self.tracker.discard(client_id, command)
+        for outcome, ids in (('delivered', delivered), ('pending', pending), ('failed', failed)):
+            if ids:
+                DISPATCH_COMMANDS.inc(len(ids), action=action, outcome=outcome)
+
+        result = {
+            'job': group_job_id(key),
+            'action': action,
+            'dispatched_at': utc_timestamp(),
+            'schedules': len(members),
+            'commands': len(client_ids),
+            'delivered': len(delivered),
+            'pending': pending,
+            'failed': failed,
+            'publish_ms': round((published - started) * 1000, 1),
+            'ack_ms': round((time.monotonic() - published) * 1000, 1),
+        }
+        self.recent.append(result)
+
+        if pending or failed:
+            log.warning(f"{result['job']}: {len(delivered)}/{len(client_ids)} command(s) acknowledged, "
+                        f"pending: {summarize(pending)}, failed: {summarize(failed)}")
+        else:
+            log.info(f"{result['job']}: {len(client_ids)} command(s) acknowledged "
+                     f"(publish {result['publish_ms']} ms, ack {result['ack_ms']} ms)")
+
+    def status(self):
+        """Groups and the latest dispatch outcomes"""
+        with self._lock:
+            groups = [{'job': group_job_id(key), 'schedules': len(members)}
+                      for key, members in self.groups.items()]
+        return {'groups': groups, 'recent': list(self.recent)}
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Gunicorn settings for the REST API (see smart-meter-api.service).
+
+Tunable through the environment, e.g. with `systemctl edit smart-meter-api`:
+    API_BIND     address to listen on (default 0.0.0.0:5001)
+    API_WORKERS  worker processes (default 2)
+    API_THREADS  threads per worker (default 6)
+    API_LIVE_CLIENTS  /api/live streams per worker (default API_THREADS - 2,
+                 at most API_THREADS - 1)
+    API_TIMEOUT  seconds before a silent worker is restarted (default 30)
+
+Reload workers without dropping requests: systemctl reload smart-meter-api
+(sends SIGHUP to the master).
+"""
+
+import os
+import subprocess
+import sys
+
+bind = os.getenv('API_BIND', '0.0.0.0:5001')
+workers = int(os.getenv('API_WORKERS', '2'))
+threads = int(os.getenv('API_THREADS', '6'))
+timeout = int(os.getenv('API_TIMEOUT', '30'))
+
+# Threaded workers: requests mostly wait on SQLite, and /api/live holds a
+# thread per connected client. Streams are capped below the thread count
+# (further clients get 503) so REST requests always find a free thread.
+worker_class = 'gthread'
+live_clients = max(min(int(os.getenv('API_LIVE_CLIENTS', threads - 2)), threads - 1), 0)
+
+# Workers finish in-flight requests on reload/stop before exiting
+graceful_timeout = 10
+
+# The app is imported in each worker after the fork, so no SQLite
+# connection or MQTT client is ever shared between processes
+preload_app = False
+
+accesslog = None
+errorlog = '-'
+loglevel = 'info'
+
+# Run in a child process: the master must never import app modules, or
+# workers forked after a reload would inherit its stale copy of them
+INIT_SCHEMA = "import sys; from database import Database; Database(sys.argv[1]).close()"
+
+def init_schema(server):
+    """Create/migrate the schema once, before workers start, so they can skip it"""
+    subprocess.run([sys.executable, '-c', INIT_SCHEMA,
+                    f"{os.getenv('HOME')}/smart_meter/scheduler.db"],
+                   cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    server.log.info("Database initialized")
+
+def on_starting(server):
+    init_schema(server)
+
+    # Inherited by the workers: skip init_database, size the reader pool
+    # to the number of request threads
+    os.environ['SMART_METER_DB_INITIALIZED'] = '1'
+    os.environ.setdefault('SMART_METER_DB_READERS', str(threads))
+    os.environ['SMART_METER_LIVE_CLIENTS'] = str(live_clients)
+
+def on_reload(server):
+    # Runs the reloaded database.py, so new tables and migrations are
+    # in place before the new workers start
+    init_schema(server)
+
+def worker_exit(server, worker):
+    """Worker: release the MQTT live feed and pooled connections"""
+    import api
+
+    api.live_feed.stop()
+    api.db.close()
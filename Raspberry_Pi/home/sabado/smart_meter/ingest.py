@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from instrumentation import counter, gauge, histogram
+
+log = logging.getLogger("ingest")
+
+INGEST_ITEMS = counter('smart_meter_ingest_items_total',
+                       'Items handled by an ingest queue, by outcome', ['queue', 'outcome'])
+INGEST_DEPTH = gauge('smart_meter_ingest_queue_depth', 'Items waiting in an ingest queue', ['queue'])
+INGEST_FLUSH_SECONDS = histogram('smart_meter_ingest_flush_seconds',
+                                 'Time to write one ingest batch', ['queue'])
+
+# A batch that finds SQLite's write lock held past busy_timeout (another
+# writer: an ingest shard, the API, retention) is retried this many times,
+# waiting LOCK_BACKOFF seconds, doubling, in between
+LOCK_RETRIES = 5
+LOCK_BACKOFF = 0.5
+
+def is_locked(error):
+    """True for SQLite's 'database is locked' / 'database is busy' errors"""
+    return isinstance(error, sqlite3.OperationalError) and (
+        'locked' in str(error) or 'busy' in str(error))
+
+class IngestQueue:
+    """
+    Bounded in-memory queue with a background writer thread.
+
+    Items are handed to write_batch(batch) in lists of up to batch_size,
+    flushed whenever the batch is full or flush_interval seconds have
+    passed since the first item of the batch was queued. on_written(batch)
+    is called on the writer thread after each successful write.
+
+    write_batch must be a single transaction: a batch that fails because
+    the database is locked is retried as a whole (see LOCK_RETRIES).
+    """
+
+    def __init__(self, write_batch, name="ingest", max_size=10000,
+                 batch_size=500, flush_interval=2.0, on_written=None):
+        self.write_batch = write_batch
+        self.on_written = on_written
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Counters (read with stats())
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self.last_flush_seconds = 0.0
+
+        # Exported from the counters above, so put() pays nothing extra
+        for outcome in ('enqueued', 'dropped', 'written', 'failed', 'retried'):
+            INGEST_ITEMS.set_function(lambda outcome=outcome: getattr(self, outcome),
+                                      queue=name, outcome=outcome)
+        INGEST_DEPTH.set_function(self.depth, queue=name)
+
+    def start(self):
+        """Start the writer thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=f"{self.name}-writer", daemon=True
+        )
+        self._thread.start()
+        log.info(f"{self.name}: writer started (batch={self.batch_size}, "
+                 f"interval={self.flush_interval}s, max={self._queue.maxsize})")
+
+    def put(self, item):
+        """
+        Queue an item without blocking the caller.
+        Returns False (and counts a drop) when the queue is full.
+        """
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            # Log the first drop and then every 1000th to avoid flooding
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                log.warning(f"{self.name}: queue full, dropped {self.dropped} item(s) so far")
+            return False
+        self.enqueued += 1
+        return True
+
+    def depth(self):
+        """Approximate number of queued items"""
+        return self._queue.qsize()
+
+    def stats(self):
+        """Snapshot of queue counters"""
+        return {
+            'depth': self.depth(),
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'written': self.written,
+            'failed': self.failed,
+            'retried': self.retried,
+            'batches': self.batches,
+            'last_flush_seconds': round(self.last_flush_seconds, 4),
+        }
+
+    def stop(self, timeout=10):
+        """Stop the writer thread after flushing everything still queued"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                log.warning(f"{self.name}: writer did not stop within {timeout}s")
+            self._thread = None
+
+        # Anything queued after the writer exited is flushed inline
+        self._drain()
+        log.info(f"{self.name}: stopped ({self.stats()})")
+
+    def _run(self):
+        """Writer loop: collect a batch, flush, repeat"""
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stop.is_set():
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._flush(batch)
+
+        self._drain()
+
+    def _drain(self):
+        """Flush all queued items in batch_size chunks"""
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._flush(batch)
+
+    def _write(self, batch):
+        """write_batch, retried with backoff while another writer holds the lock"""
+        delay = LOCK_BACKOFF
+        for attempt in range(LOCK_RETRIES + 1):
+            try:
+                return self.write_batch(batch)
+            except Exception as e:
+                if attempt == LOCK_RETRIES or not is_locked(e):
+                    raise
+                self.retried += len(batch)
+                log.warning(f"{self.name}: database locked, retrying batch of "
+                            f"{len(batch)} in {delay}s")
+                time.sleep(delay)
+                delay *= 2
+
+    def _flush(self, batch):
+        """Hand one batch to the writer, never letting an error kill the thread"""
+        started = time.monotonic()
+        try:
+            self._write(batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            log.error(f"{self.name}: failed to write batch of {len(batch)}: {e}")
+            return
+        finally:
+            self.last_flush_seconds = time.monotonic() - started
+            INGEST_FLUSH_SECONDS.observe(self.last_flush_seconds, queue=self.name)
+
+        if self.on_written:
+            try:
+                self.on_written(batch)
+            except Exception as e:
+                log.error(f"{self.name}: post-write handler failed: {e}")
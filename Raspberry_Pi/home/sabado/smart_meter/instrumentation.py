@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Default histogram buckets (seconds): 0.5 ms .. 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metric:
+    """Base for a metric family; values are kept per label-value tuple"""
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+class ValueMetric(Metric):
+    """Single value per label set, either stored or read from a function"""
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._functions = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, func, **labels):
+        """
+        Read the value from func() whenever metrics are collected, e.g. to
+        export a counter an object already keeps without touching its hot path
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = func
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, func in functions.items():
+            try:
+                values[key] = func()
+            except Exception:
+                continue
+        return [('', self._labels(key), value) for key, value in values.items()]
+
+class Counter(ValueMetric):
+    """Monotonically increasing count"""
+
+    type = 'counter'
+
+class Gauge(ValueMetric):
+    """Value that goes up and down"""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts (+Inf last), sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            else:
+                state[0][-1] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+
+        samples = []
+        for key, counts, total in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(('_bucket', {**labels, 'le': format_value(bound)}, cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+class Registry:
+    """Named metric families of one process"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} already registered differently")
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def collect(self):
+        """
+        JSON-serialisable snapshot: list of families
+        {name, type, help, samples: [[suffix, labels, value], ...]}
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [{
+            'name': metric.name,
+            'type': metric.type,
+            'help': metric.help,
+            'samples': [list(sample) for sample in metric.samples()]
+        } for metric in metrics]
+
+# Metrics of this process
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def with_labels(families, **labels):
+    """Copy of collected families with extra labels added to every sample"""
+    return [dict(family, samples=[[suffix, {**sample_labels, **labels}, value]
+                                  for suffix, sample_labels, value in family['samples']])
+            for family in families]
+
+def render(*family_lists):
+    """
+    Prometheus text exposition (format 0.0.4) of one or more collected
+    family lists. Families with the same name (e.g. from different
+    processes) are merged under one HELP/TYPE header.
+    """
+    merged = {}
+    for families in family_lists:
+        for family in families:
+            entry = merged.setdefault(family['name'], dict(family, samples=[]))
+            entry['samples'].extend(family['samples'])
+
+    lines = []
+    for name, family in merged.items():
+        if not family['samples']:
+            continue
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for suffix, labels, value in family['samples']:
+            label_text = ','.join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+            label_text = f'{{{label_text}}}' if label_text else ''
+            lines.append(f"{name}{suffix}{label_text} {format_value(value)}")
+    return '\n'.join(lines) + '\n'
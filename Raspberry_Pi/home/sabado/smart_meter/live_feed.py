@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from database import utc_timestamp
+from mqtt_client import MQTTSchedulerClient
+
+log = logging.getLogger("live-feed")
+
+# Event types pushed to subscribers
+EVENT_TYPES = ('energy', 'metrics', 'status', 'relay_state', 'threshold_alert')
+
+class Subscription:
+    """
+    One connected client's view of the feed. Pending events are coalesced
+    per (type, client_id): a slow client gets the latest value of each,
+    never a growing backlog.
+    """
+
+    def __init__(self, feed, client_ids=None, types=None):
+        self.feed = feed
+        self.client_ids = set(client_ids) if client_ids else None
+        self.types = set(types) if types else None
+
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def wants(self, event):
+        return ((self.client_ids is None or event['client_id'] in self.client_ids)
+                and (self.types is None or event['type'] in self.types))
+
+    def offer(self, event):
+        """Queue an event, replacing any undelivered one with the same key"""
+        if not self.wants(event):
+            return
+        with self._cond:
+            # Replacing keeps the key's place, so busy devices can't starve quiet ones
+            self._pending[(event['type'], event['client_id'])] = event
+            self._cond.notify()
+
+    def get(self, timeout):
+        """Wait up to timeout seconds and return all pending events (maybe none)"""
+        with self._cond:
+            if not self._pending and not self.closed:
+                self._cond.wait(timeout)
+            events = list(self._pending.values())
+            self._pending.clear()
+            return events
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self.feed.unsubscribe(self)
+
+class LiveFeed:
+    """
+    Fans out live MQTT telemetry to any number of subscribers from a
+    single broker connection per process, started on first use. The
+    latest event per (type, client_id) is kept so new subscribers start
+    with the current state.
+    """
+
+    def __init__(self, broker='localhost', port=1883, max_subscribers=50):
+        self.broker = broker
+        self.port = port
+        self.max_subscribers = max_subscribers
+
+        self.mqtt = None
+        self._latest = {}
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Connect and subscribe (no-op if already running)"""
+        with self._lock:
+            if self.mqtt is not None:
+                return
+
+            client = MQTTSchedulerClient(self.broker, self.port,
+                                         client_id=f"api-live-feed-{os.getpid()}")
+            client.on_energy_reading = lambda client_id, kwh: self._publish(
+                'energy', client_id, {'energy_kwh': kwh})
+            client.on_metrics = lambda client_id, voltage, current, power: self._publish(
+                'metrics', client_id, {'voltage': voltage, 'current': current, 'power': power})
+            client.on_device_event = self._on_device_event
+            client.on_threshold_alert = lambda client_id, alert: self._publish(
+                'threshold_alert', client_id, alert)
+
+            client.connect()
+            self.mqtt = client
+            log.info("Live feed connected")
+
+    def stop(self):
+        with self._lock:
+            if self.mqtt is not None:
+                self.mqtt.disconnect()
+                self.mqtt = None
+
+    def subscribe(self, client_ids=None, types=None):
+        """
+        New Subscription seeded with the latest known events. Raises
+        RuntimeError when max_subscribers clients are already connected.
+        """
+        self.start()
+
+        subscription = Subscription(self, client_ids, types)
+        with self._lock:
+            if len(self._subscriptions) >= self.max_subscribers:
+                raise RuntimeError(f"Too many live feed clients (max {self.max_subscribers})")
+            self._subscriptions.add(subscription)
+            latest = list(self._latest.values())
+
+        for event in latest:
+            subscription.offer(event)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def subscriber_count(self):
+        return len(self._subscriptions)
+
+    def _on_device_event(self, client_id, field, value, live):
+        # Heartbeats only matter to the device registry
+        if field is not None:
+            self._publish(field, client_id, {field: value})
+
+    def _publish(self, event_type, client_id, data):
+        """Runs on the paho network thread: never blocks on a subscriber"""
+        event = {'type': event_type, 'client_id': client_id,
+                 'received_at': utc_timestamp(), **data}
+        with self._lock:
+            self._latest[(event_type, client_id)] = event
+            subscriptions = list(self._subscriptions)
+
+        for subscription in subscriptions:
+            subscription.offer(event)
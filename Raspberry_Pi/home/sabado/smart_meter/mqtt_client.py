@@ -3,22 +3,56 @@
 import paho.mqtt.client as mqtt
 import json
 import logging
+import time
 from datetime import datetime
+from instrumentation import counter, gauge, histogram
 
 log = logging.getLogger("mqtt-client")
 
+# QoS 1 messages awaiting PUBACK at once (paho's default of 20 throttles
+# a burst of relay commands to one broker round trip per 20 devices)
+MAX_INFLIGHT_MESSAGES = 200
+
+# Telemetry and device state from all devices (wildcards)
+DEVICE_TOPICS = ["dev/+/pzem/energy", "dev/+/pzem/metrics", "dev/+/status",
+                 "dev/+/heartbeat", "dev/+/relay/state"]
+
+MQTT_CONNECTS = counter('smart_meter_mqtt_connects_total', 'Broker connection attempts answered, by result', ['result'])
+MQTT_RECONNECTS = counter('smart_meter_mqtt_reconnects_total', 'Successful connections after the first one')
+MQTT_DISCONNECTS = counter('smart_meter_mqtt_disconnects_total', 'Broker disconnections', ['expected'])
+MQTT_CONNECTED = gauge('smart_meter_mqtt_connected', 'Whether the broker connection is up')
+MQTT_MESSAGES = counter('smart_meter_mqtt_messages_total', 'Messages received, by kind', ['kind'])
+MQTT_INVALID = counter('smart_meter_mqtt_invalid_messages_total', 'Messages dropped as unparsable, by kind', ['kind'])
+MQTT_PUBLISHED = counter('smart_meter_mqtt_published_total', 'Messages published, by kind', ['kind'])
+MQTT_HANDLER_SECONDS = histogram('smart_meter_mqtt_handler_seconds',
+                                 'Time spent handling one received message on the network thread')
+
 class MQTTSchedulerClient:
-    def __init__(self, broker, port):
+    def __init__(self, broker, port, client_id="scheduler-service"):
         self.broker = broker
         self.port = port
 
-        self.client = mqtt.Client(client_id="scheduler-service")
+        # Must be unique per connection: the broker drops the older session
+        # when a second client connects with the same ID
+        self.client = mqtt.Client(client_id=client_id)
+        self.client.max_inflight_messages_set(MAX_INFLIGHT_MESSAGES)
 
         self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
+        self._connected_before = False
+
+        # Topics subscribed on connect, and an optional router(topic,
+        # payload, retain) that may take a message instead of it being
+        # parsed here (returns True if it did; sharded ingest)
+        self.topics = list(DEVICE_TOPICS)
+        self.router = None
 
         # Callback placeholders
         self.on_energy_reading = None
+        self.on_metrics = None
+        self.on_device_event = None
+        self.on_threshold_alert = None
  
     def connect(self):
         """Connect to MQTT broker"""
@@ -35,20 +69,45 @@ class MQTTSchedulerClient:
         """Callback when connected"""
         if rc == 0:
             log.info("Connected to MQTT broker")
-            # Subscribe to all energy readings using wildcard
-            self.client.subscribe("dev/+/pzem/energy")
-            log.info("Subscribed to dev/+/pzem/energy")
+            MQTT_CONNECTS.inc(result='ok')
+            MQTT_CONNECTED.set(1)
+            if self._connected_before:
+                MQTT_RECONNECTS.inc()
+            self._connected_before = True
+            # Subscribe to telemetry and device state from all devices using wildcards
+            topics = list(self.topics)
+            if self.on_threshold_alert:
+                topics.append("dev/+/threshold/alert")
+            self.client.subscribe([(topic, 0) for topic in topics])
+            log.info(f"Subscribed to {', '.join(topics)}")
         else:
+            MQTT_CONNECTS.inc(result='failed')
             log.error(f"Failed to connect, return code {rc}")
 
+    def _on_disconnect(self, client, userdata, rc):
+        """Callback when disconnected; rc 0 means disconnect() was called"""
+        MQTT_CONNECTED.set(0)
+        MQTT_DISCONNECTS.inc(expected=str(rc == 0).lower())
+        if rc != 0:
+            log.warning(f"Unexpectedly disconnected from MQTT broker (rc={rc}), reconnecting")
+
     def _on_message(self, client, userdata, msg):
         """Handle incoming MQTT messages"""
-        topic = msg.topic
-        payload = msg.payload.decode()
+        started = time.perf_counter()
+        try:
+            if not (self.router and self.router(msg.topic, msg.payload, msg.retain)):
+                self.handle_message(msg.topic, msg.payload, msg.retain)
+        finally:
+            MQTT_HANDLER_SECONDS.observe(time.perf_counter() - started)
+
+    def handle_message(self, topic, payload, retain=False):
+        """Parse one message and invoke the matching callback"""
+        payload = payload.decode()
 
         # Parse energy readings: dev/<CLIENT_ID>/pzem/energy
         if '/pzem/energy' in topic:
             client_id = topic.split('/')[1]  # Extract ESP32-XXXXXXXX
+            MQTT_MESSAGES.inc(kind='energy')
 
             try:
                 energy_kwh = float(payload)
@@ -57,16 +116,114 @@ class MQTTSchedulerClient:
                 if self.on_energy_reading:
                     self.on_energy_reading(client_id, energy_kwh)
             except ValueError:
+                MQTT_INVALID.inc(kind='energy')
                 log.error(f"Invalid energy value: {payload}")
 
+        # Parse power metrics: dev/<CLIENT_ID>/pzem/metrics
+        # {"voltage":220.5,"current":1.2,"power":264.6}
+        elif '/pzem/metrics' in topic:
+            client_id = topic.split('/')[1]
+            MQTT_MESSAGES.inc(kind='metrics')
+
+            try:
+                metrics = json.loads(payload)
+                voltage = float(metrics['voltage'])
+                current = float(metrics['current'])
+                power = float(metrics['power'])
+            except (ValueError, KeyError, TypeError):
+                MQTT_INVALID.inc(kind='metrics')
+                log.error(f"Invalid metrics payload from {client_id}: {payload}")
+                return
+
+            if self.on_metrics:
+                self.on_metrics(client_id, voltage, current, power)
+
+        # Device state: dev/<CLIENT_ID>/status ("Online"/"Offline"),
+        # dev/<CLIENT_ID>/heartbeat, dev/<CLIENT_ID>/relay/state ("0"/"1")
+        elif topic.endswith(('/status', '/heartbeat', '/relay/state')):
+            client_id = topic.split('/')[1]
+
+            if topic.endswith('/status'):
+                field, value = 'status', payload
+                MQTT_MESSAGES.inc(kind='status')
+            elif topic.endswith('/relay/state'):
+                MQTT_MESSAGES.inc(kind='relay_state')
+                if payload not in ('0', '1'):
+                    MQTT_INVALID.inc(kind='relay_state')
+                    log.error(f"Invalid relay state from {client_id}: {payload}")
+                    return
+                field, value = 'relay_state', int(payload)
+            else:
+                field, value = None, None
+                MQTT_MESSAGES.inc(kind='heartbeat')
+
+            if self.on_device_event:
+                # Retained messages are replays, not proof the device is alive
+                self.on_device_event(client_id, field, value, not retain)
+
+        # Threshold alerts published by the scheduler: dev/<CLIENT_ID>/threshold/alert
+        elif topic.endswith('/threshold/alert'):
+            client_id = topic.split('/')[1]
+            MQTT_MESSAGES.inc(kind='threshold_alert')
+
+            # An empty retained message clears the alert
+            if not payload:
+                return
+            try:
+                alert = json.loads(payload)
+            except ValueError:
+                MQTT_INVALID.inc(kind='threshold_alert')
+                log.error(f"Invalid threshold alert from {client_id}: {payload}")
+                return
+
+            if self.on_threshold_alert:
+                self.on_threshold_alert(client_id, alert)
+
     def publish_relay_command(self, client_id, command):
         """
         Publish relay command to ESP32
         Command: RELAY_ON or RELAY_OFF
         """
         topic = f"dev/{client_id}/relay/commands"
-        self.client.publish(topic, command, qos=1)
+        info = self.client.publish(topic, command, qos=1)
+        MQTT_PUBLISHED.inc(kind='relay_command')
         log.info(f"Published {command} to {topic}")
+        return info
+
+    def publish_relay_commands(self, client_ids, command):
+        """
+        Publish the same relay command to many devices back to back
+        Returns {client_id: MQTTMessageInfo} for wait_for_delivery
+        """
+        infos = {client_id: self.client.publish(f"dev/{client_id}/relay/commands", command, qos=1)
+                 for client_id in client_ids}
+        MQTT_PUBLISHED.inc(len(infos), kind='relay_command')
+        log.info(f"Published {command} to {len(infos)} device(s)")
+        return infos
+
+    def wait_for_delivery(self, infos, timeout):
+        """
+        Wait up to timeout seconds in total for the broker to acknowledge
+        published messages. Returns (delivered, pending, failed) lists of
+        keys: pending messages are still queued (e.g. while reconnecting)
+        and paho keeps retrying them, failed ones were rejected outright.
+        """
+        deadline = time.monotonic() + timeout
+        delivered, pending, failed = [], [], []
+
+        for key, info in infos.items():
+            if info.rc == mqtt.MQTT_ERR_NO_CONN:
+                pending.append(key)
+                continue
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                failed.append(key)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                info.wait_for_publish(remaining)
+            (delivered if info.is_published() else pending).append(key)
+
+        return delivered, pending, failed
 
     def publish_threshold_alert(self, client_id, consumption, limit):
         """Publish threshold alert"""
@@ -77,4 +234,5 @@ class MQTTSchedulerClient:
             "exceeded_at": datetime.now().isoformat()
         }
         self.client.publish(topic, json.dumps(alert), qos=1, retain=True)
+        MQTT_PUBLISHED.inc(kind='threshold_alert')
         log.info(f"Published threshold alert for {client_id}")
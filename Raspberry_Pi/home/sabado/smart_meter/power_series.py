@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import struct
+from datetime import datetime, timezone
+from database import TIMESTAMP_FORMAT
+
+# One sample: milliseconds since chunk start, voltage, current, power
+SAMPLE = struct.Struct('<Ifff')
+
+# Samples are packed into one blob per device per hour
+CHUNK_SECONDS = 3600
+
+def to_epoch(when):
+    """Naive UTC datetime -> unix seconds"""
+    return when.replace(tzinfo=timezone.utc).timestamp()
+
+def from_epoch(seconds):
+    """Unix seconds -> naive UTC datetime"""
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+class PowerSeriesStore:
+    """
+    Stores pzem/metrics samples as packed fixed-width records in the
+    power_chunks table (16 bytes per sample instead of one row each)
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def write_samples(self, samples):
+        """
+        Append a batch of (client_id, epoch_seconds, voltage, current, power)
+        samples, one upsert per device-hour chunk
+        """
+        chunks = {}
+        for client_id, at, voltage, current, power in samples:
+            chunk_start = int(at) - int(at) % CHUNK_SECONDS
+            offset_ms = int((at - chunk_start) * 1000)
+            chunks.setdefault((client_id, chunk_start), []).append(
+                SAMPLE.pack(offset_ms, voltage, current, power)
+            )
+
+        self.db.append_power_chunks([
+            (client_id, chunk_start, len(packed), b''.join(packed))
+            for (client_id, chunk_start), packed in chunks.items()
+        ])
+
+    def _iter_samples(self, client_id, start, end):
+        """Decoded samples between two naive UTC datetimes, in storage order"""
+        start_s, end_s = to_epoch(start), to_epoch(end)
+
+        for chunk_start, data in self.db.get_power_chunks(
+                client_id, int(start_s) - CHUNK_SECONDS, int(end_s)):
+            for offset_ms, voltage, current, power in SAMPLE.iter_unpack(data):
+                at = chunk_start + offset_ms / 1000
+                if start_s <= at <= end_s:
+                    yield at, voltage, current, power
+
+    def get_series(self, client_id, start, end, bucket_seconds, origin=0):
+        """
+        Downsampled series: one point per bucket with avg/min/max power and
+        average voltage/current. Buckets are aligned to multiples of
+        bucket_seconds after the epoch time `origin`.
+        """
+        buckets = {}
+        for at, voltage, current, power in self._iter_samples(client_id, start, end):
+            key = int(at) - int(at - origin) % bucket_seconds
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [1, power, power, power, voltage, current]
+                continue
+            bucket[0] += 1
+            bucket[1] += power
+            bucket[2] = min(bucket[2], power)
+            bucket[3] = max(bucket[3], power)
+            bucket[4] += voltage
+            bucket[5] += current
+
+        return [{
+            'timestamp': from_epoch(key).strftime(TIMESTAMP_FORMAT),
+            'samples': count,
+            'power_avg': round(power_sum / count, 2),
+            'power_min': round(power_min, 2),
+            'power_max': round(power_max, 2),
+            'voltage_avg': round(voltage_sum / count, 2),
+            'current_avg': round(current_sum / count, 3)
+        } for key, (count, power_sum, power_min, power_max, voltage_sum, current_sum)
+            in sorted(buckets.items())]
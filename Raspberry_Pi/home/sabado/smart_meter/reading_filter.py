@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import logging
+import time
+from datetime import datetime, timezone
+from database import TIMESTAMP_FORMAT
+from instrumentation import counter
+
+log = logging.getLogger("reading-filter")
+
+READINGS_FILTERED = counter('smart_meter_readings_filtered_total',
+                            'Energy readings checked by the deadband filter, by outcome', ['outcome'])
+
+class ReadingFilter:
+    """
+    Deadband in front of the energy ingest queue. Meters publish their
+    cumulative reading at a fixed interval with two decimals, and the
+    broker replays the retained value on every reconnect, so most
+    readings repeat the last stored one.
+
+    A reading is stored when it is the device's first, when it is lower
+    than the last stored value (meter reset), when it exceeds it by more
+    than tolerance_kwh, or when keepalive_seconds have passed since the
+    last stored reading. Consumption is computed from deltas between
+    stored readings, so suppressing the rest loses at most tolerance_kwh
+    at the tail, and that is caught up by the next stored reading.
+    """
+
+    def __init__(self, tolerance_kwh=0.0, keepalive_seconds=900):
+        self.tolerance_kwh = tolerance_kwh
+        self.keepalive_seconds = keepalive_seconds
+
+        # client_id -> (last stored energy_kwh, unix time it was stored)
+        self._last = {}
+
+        # Counters (read with stats())
+        self.passed = 0
+        self.suppressed = 0
+
+        READINGS_FILTERED.set_function(lambda: self.passed, outcome='passed')
+        READINGS_FILTERED.set_function(lambda: self.suppressed, outcome='suppressed')
+
+    def seed(self, devices):
+        """Start from each device's latest stored reading (Database.get_devices rows)"""
+        seeded = 0
+        for device in devices:
+            if device.get('last_energy_kwh') is None or not device.get('last_energy_at'):
+                continue
+            stored_at = datetime.strptime(device['last_energy_at'], TIMESTAMP_FORMAT)
+            self._last[device['client_id']] = (
+                device['last_energy_kwh'],
+                stored_at.replace(tzinfo=timezone.utc).timestamp()
+            )
+            seeded += 1
+        log.info(f"Seeded last readings of {seeded} device(s)")
+
+    def accept(self, client_id, energy_kwh, now=None):
+        """
+        True if the reading should be stored (and remember it as the last
+        stored value), False if it is redundant
+        """
+        now = time.time() if now is None else now
+        last = self._last.get(client_id)
+
+        if last is not None:
+            last_kwh, stored_at = last
+            if (last_kwh <= energy_kwh <= last_kwh + self.tolerance_kwh
+                    and now - stored_at < self.keepalive_seconds):
+                self.suppressed += 1
+                return False
+
+        self._last[client_id] = (energy_kwh, now)
+        self.passed += 1
+        return True
+
+    def forget(self, client_id):
+        """Drop a device's state, e.g. when an accepted reading could not be queued"""
+        self._last.pop(client_id, None)
+
+    def stats(self):
+        """Snapshot of filter counters"""
+        return {
+            'devices': len(self._last),
+            'passed': self.passed,
+            'suppressed': self.suppressed,
+        }
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from collections import deque
+from database import utc_timestamp
+from instrumentation import counter, gauge, histogram
+
+log = logging.getLogger("relay-tracker")
+
+# Relay state a device reports once it has executed a command
+EXPECTED_STATE = {'RELAY_ON': 1, 'RELAY_OFF': 0}
+
+RELAY_COMMANDS = counter('smart_meter_relay_commands_total',
+                         'Tracked relay commands by outcome', ['source', 'outcome'])
+RELAY_RETRIES = counter('smart_meter_relay_retries_total', 'Relay commands re-sent after an ack timeout')
+RELAY_OUTSTANDING = gauge('smart_meter_relay_outstanding', 'Relay commands waiting for the device to confirm')
+RELAY_ACTUATION_SECONDS = histogram('smart_meter_relay_actuation_seconds',
+                                    'From first publish to the device reporting the new relay state',
+                                    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+
+class RelayAckTracker:
+    """
+    Confirms relay commands against the relay/state each device publishes
+    after switching. A command is acknowledged by the first live state
+    message matching it; without one within ack_timeout seconds it is
+    re-sent, doubling the timeout each time, and given up on after
+    max_attempts sends. A newer command for the same device supersedes
+    an outstanding one.
+
+    Latency from the first send to the acknowledgement is recorded per
+    device. Retries run on a background thread; observe_state is called
+    from the MQTT thread and only does a dictionary lookup.
+    """
+
+    def __init__(self, publish, ack_timeout=10.0, max_attempts=4, history=100):
+        self.publish = publish
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max_attempts
+
+        # client_id -> outstanding command
+        self._outstanding = {}
+        # client_id -> actuation latency summary
+        self._latency = {}
+        self.failed = deque(maxlen=history)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        RELAY_OUTSTANDING.set_function(lambda: len(self._outstanding))
+
+    def start(self):
+        """Start the retry thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="relay-tracker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+
+    def send(self, client_id, command, source):
+        """Publish a relay command and track it until the device confirms it"""
+        # Tracked first: a fast device can report its new state before
+        # publish() returns, and that report must find the entry
+        self.track(client_id, command, source)
+        try:
+            self.publish(client_id, command)
+        except Exception:
+            self.discard(client_id, command)
+            raise
+
+    def track(self, client_id, command, source):
+        """Track a command about to be published (e.g. in a burst)"""
+        now = time.monotonic()
+        entry = {
+            'client_id': client_id,
+            'command': command,
+            'source': source,
+            'sent_at': utc_timestamp(),
+            'attempts': 1,
+            'first_sent': now,
+            'deadline': now + self.ack_timeout,
+        }
+        with self._lock:
+            previous = self._outstanding.get(client_id)
+            self._outstanding[client_id] = entry
+        if previous:
+            RELAY_COMMANDS.inc(source=previous['source'], outcome='superseded')
+        self._wakeup.set()
+
+    def track_many(self, client_ids, command, source):
+        for client_id in client_ids:
+            self.track(client_id, command, source)
+
+    def discard(self, client_id, command):
+        """Stop tracking a command whose publish failed (no outcome is counted)"""
+        with self._lock:
+            entry = self._outstanding.get(client_id)
+            if entry is not None and entry['command'] == command:
+                del self._outstanding[client_id]
+
+    def observe_state(self, client_id, state, live):
+        """relay/state message from a device; retained replays never count as an ack"""
+        if not live:
+            return
+        with self._lock:
+            entry = self._outstanding.get(client_id)
+            if entry is None or EXPECTED_STATE.get(entry['command']) != state:
+                return
+            del self._outstanding[client_id]
+
+        latency = time.monotonic() - entry['first_sent']
+        RELAY_ACTUATION_SECONDS.observe(latency)
+        RELAY_COMMANDS.inc(source=entry['source'], outcome='acked')
+        self._record_latency(client_id, latency, entry['attempts'])
+
+    def _device_stats(self, client_id):
+        """Latency summary of a device (call with the lock held)"""
+        return self._latency.setdefault(client_id, {
+            'acked': 0, 'failed': 0, 'retried': 0,
+            'last_ms': None, 'avg_ms': None, 'max_ms': None
+        })
+
+    def _record_latency(self, client_id, latency, attempts):
+        latency_ms = round(latency * 1000, 1)
+        with self._lock:
+            stats = self._device_stats(client_id)
+            stats['acked'] += 1
+            stats['retried'] += attempts > 1
+            stats['last_ms'] = latency_ms
+            stats['max_ms'] = max(stats['max_ms'] or 0, latency_ms)
+            # Running mean over all acknowledged commands
+            previous = stats['avg_ms'] or 0
+            stats['avg_ms'] = round(previous + (latency_ms - previous) / stats['acked'], 1)
+
+    def _run(self):
+        """Retry loop: sleep until the earliest deadline, then handle overdue commands"""
+        while not self._stop.is_set():
+            # Cleared before scanning so a command tracked meanwhile wakes us again
+            self._wakeup.clear()
+            now = time.monotonic()
+            retry, give_up = [], []
+
+            with self._lock:
+                for client_id, entry in list(self._outstanding.items()):
+                    if entry['deadline'] > now:
+                        continue
+                    if entry['attempts'] >= self.max_attempts:
+                        del self._outstanding[client_id]
+                        give_up.append(entry)
+                    else:
+                        entry['attempts'] += 1
+                        entry['deadline'] = now + self.ack_timeout * 2 ** (entry['attempts'] - 1)
+                        retry.append(entry)
+                next_deadline = min((e['deadline'] for e in self._outstanding.values()), default=None)
+
+            for entry in retry:
+                log.warning(f"No relay state from {entry['client_id']} for {entry['command']}, "
+                            f"re-sending (attempt {entry['attempts']}/{self.max_attempts})")
+                RELAY_RETRIES.inc()
+                try:
+                    self.publish(entry['client_id'], entry['command'])
+                except Exception as e:
+                    log.error(f"Failed to re-send {entry['command']} to {entry['client_id']}: {e}")
+
+            for entry in give_up:
+                log.error(f"{entry['command']} ({entry['source']}) to {entry['client_id']} "
+                          f"not confirmed after {entry['attempts']} attempt(s)")
+                RELAY_COMMANDS.inc(source=entry['source'], outcome='failed')
+                with self._lock:
+                    self._device_stats(entry['client_id'])['failed'] += 1
+                self.failed.append({key: entry[key] for key in
+                                    ('client_id', 'command', 'source', 'sent_at', 'attempts')})
+
+            timeout = None if next_deadline is None else max(next_deadline - time.monotonic(), 0)
+            self._wakeup.wait(timeout)
+
+    def status(self, client_id=None):
+        """Outstanding and failed commands plus latency per device (optionally one device)"""
+        now = time.monotonic()
+        with self._lock:
+            outstanding = [{
+                'client_id': entry['client_id'],
+                'command': entry['command'],
+                'source': entry['source'],
+                'sent_at': entry['sent_at'],
+                'attempts': entry['attempts'],
+                'waiting_seconds': round(now - entry['first_sent'], 1),
+            } for entry in self._outstanding.values()
+              if client_id is None or entry['client_id'] == client_id]
+            devices = {cid: dict(stats) for cid, stats in self._latency.items()
+                       if client_id is None or cid == client_id}
+
+        return {
+            'outstanding': outstanding,
+            'failed': [f for f in self.failed if client_id is None or f['client_id'] == client_id],
+            'devices': devices,
+        }
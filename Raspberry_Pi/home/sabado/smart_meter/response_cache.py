@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from collections import OrderedDict
+
+class ResponseCache:
+    """
+    Small LRU cache of rendered response bodies. Each entry remembers the
+    data versions (see Database.get_versions) it was rendered from and is
+    only served while those versions are unchanged and it is younger than
+    ttl seconds. The ttl covers data that changes with time alone, like
+    a device going offline or a new period starting.
+    """
+
+    def __init__(self, ttl=5.0, max_entries=256, max_body_bytes=256 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters (read with stats())
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, versions):
+        """(etag, body, mimetype) for key if still valid for versions, else None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != versions or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2:]
+
+    def put(self, key, versions, etag, body, mimetype):
+        """Store a rendered body; bodies over max_body_bytes are not kept"""
+        if len(body) > self.max_body_bytes:
+            return
+        with self._lock:
+            self._entries[key] = (versions, time.monotonic() + self.ttl, etag, body, mimetype)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Snapshot of cache counters"""
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
 
+import argparse
 import logging
 import signal
 import sys
+import threading
+import time
 import os
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.date import DateTrigger
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from mqtt_client import MQTTSchedulerClient
-from database import Database
+from database import Database, utc_now, utc_timestamp, TIMESTAMP_FORMAT
+from ingest import IngestQueue
+from reading_filter import ReadingFilter
+from retention import ReadingArchive, RetentionManager
+from control import ControlServer
+from power_series import PowerSeriesStore
+from dispatcher import RelayDispatcher
+from relay_tracker import RelayAckTracker
+from shards import ShardSupervisor
+from instrumentation import REGISTRY, counter, gauge, histogram
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,43 +30,241 @@ logging.basicConfig(
 )
 log = logging.getLogger("smart-meter-scheduler")
 
+THRESHOLD_CHECK_SECONDS = histogram('smart_meter_threshold_check_seconds',
+                                    'Time to evaluate the thresholds of a batch or sweep', ['trigger'])
+THRESHOLDS_TRIGGERED = counter('smart_meter_thresholds_triggered_total', 'Thresholds exceeded and cut off')
+THRESHOLDS_ACTIVE = gauge('smart_meter_thresholds_active', 'Enabled thresholds being monitored')
+JOB_LAG_SECONDS = histogram('smart_meter_job_lag_seconds',
+                            'Delay between a job\'s scheduled time and its submission', ['job'],
+                            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 60.0, 300.0))
+JOB_EVENTS = counter('smart_meter_job_events_total', 'Jobs that failed or missed their run time', ['job', 'event'])
+JOBS_SCHEDULED = gauge('smart_meter_jobs_scheduled', 'Jobs currently in the scheduler')
+
+# Jobs may start up to this late (busy scheduler, quick restart) and still
+# run; a backlog of missed runs of one job is coalesced into a single run
+MISFIRE_GRACE_SECONDS = 300
+
+def schedule_fingerprint(schedule):
+    """Fields that define a schedule's jobs; jobs are only rebuilt when it changes"""
+    return tuple(schedule.get(key) for key in
+                 ('schedule_type', 'start_time', 'end_time', 'days_of_week', 'fire_at'))
+
+def parse_utc(timestamp):
+    """Aware UTC datetime from a timestamp column value"""
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+
+def job_kind(job_id):
+    """Metric label for a job: schedule/timer jobs are grouped, not labelled per schedule"""
+    if job_id.startswith(('schedule_', 'timer_', 'dispatch_')):
+        return job_id.split('_')[0]
+    return job_id
+
 class SmartMeterScheduler:
-    def __init__(self):
-        self.db = Database(f"{os.getenv('HOME')}/smart_meter/scheduler.db")
-        self.mqtt = MQTTSchedulerClient('localhost', 1883)
-        self.scheduler = BackgroundScheduler()
+    # Overridden by the asyncio variant (async_service.py)
+    mqtt_client_class = MQTTSchedulerClient
+    ingest_queue_class = IngestQueue
+
+    def __init__(self, data_dir=None, broker='localhost', port=1883, shards=0):
+        """
+        data_dir holds scheduler.db, the archive and the control socket.
+        shards > 0 moves energy, power and status ingest into that many
+        worker processes (see ShardSupervisor).
+        """
+        data_dir = data_dir or f"{os.getenv('HOME')}/smart_meter"
+
+        self.db = Database(f"{data_dir}/scheduler.db")
+        self.mqtt = self.mqtt_client_class(broker, port)
+        self.scheduler = BackgroundScheduler(job_defaults={
+            'coalesce': True,
+            'misfire_grace_time': MISFIRE_GRACE_SECONDS
+        })
+
+        # schedule_id -> schedule_fingerprint of the jobs currently scheduled.
+        # Jobs live in APScheduler's memory store, so this starts empty and
+        # the first sync rebuilds every schedule; there is nothing to reuse
+        self.job_fingerprints = {}
+
+        # Relay commands are re-sent until the device reports the new state
+        self.relay_tracker = RelayAckTracker(self.mqtt.publish_relay_command)
+
+        # Daily transitions sharing a trigger run as one job per group
+        self.dispatcher = RelayDispatcher(self.scheduler, self.mqtt, self.db,
+                                          tracker=self.relay_tracker)
+
+        # Raw readings older than RETENTION_DAYS are moved to the archive
+        self.retention = RetentionManager(
+            self.db,
+            ReadingArchive(f"{data_dir}/archive"),
+            keep_days=int(os.getenv('RETENTION_DAYS', '90'))
+        )
+
+        # Active thresholds by client_id, checked as each device's readings land
+        self.thresholds = {}
+        self.thresholds_lock = threading.Lock()
+        # Ids of thresholds tripped but not yet disabled in the database
+        self.thresholds_tripping = set()
+
+        # Repeated readings (unchanged meter, retained replays) are dropped
+        # before they reach the queue
+        self.reading_filter = ReadingFilter(
+            tolerance_kwh=float(os.getenv('READING_TOLERANCE_KWH', '0')),
+            keepalive_seconds=int(os.getenv('READING_KEEPALIVE_SECONDS', '900'))
+        )
+
+        # Readings are queued here and written in batches off the MQTT thread
+        self.ingest = self.ingest_queue_class(
+            self.db.store_energy_readings,
+            name="energy-ingest",
+            on_written=self.handle_readings_written
+        )
+
+        # Power metrics arrive far more often than energy; buffer them longer
+        self.power_series = PowerSeriesStore(self.db)
+        self.power_ingest = self.ingest_queue_class(
+            self.power_series.write_samples,
+            name="power-ingest",
+            batch_size=2000,
+            flush_interval=10.0
+        )
+
+        # Status/heartbeat/relay state updates for the device registry
+        self.device_ingest = self.ingest_queue_class(
+            self.db.update_devices,
+            name="device-ingest",
+            flush_interval=5.0
+        )
+
+        # Sharded: telemetry is routed to the workers, which report stored
+        # batches for threshold checks; relay state is still handled here
+        self.shards = None
+        if shards:
+            self.shards = ShardSupervisor(shards, data_dir, on_written=self.check_devices)
+            self.mqtt.router = self.shards.route
 
         # Subscribe to energy readings for threshold monitoring
         self.mqtt.on_energy_reading = self.handle_energy_reading
+        self.mqtt.on_metrics = self.handle_metrics
+        self.mqtt.on_device_event = self.handle_device_event
+
+        # The API tells us about schedule changes here instead of restarting us
+        self.control = ControlServer({
+            'ping': lambda: {},
+            'reload_schedule': self.reload_schedule,
+            'remove_schedule': self.remove_schedule_jobs,
+            'sync_schedules': self.sync_schedules,
+            'dispatch_status': self.dispatcher.status,
+            'relay_commands': self.relay_tracker.status,
+            'reload_threshold': self.reload_threshold,
+            'shard_status': lambda: self.shards.status() if self.shards else {'shards': []},
+            'metrics': lambda: {'families': REGISTRY.collect()
+                                + (self.shards.families() if self.shards else [])},
+        }, socket_path=f"{data_dir}/scheduler.sock")
 
     def start(self):
         """Initialize and start all services"""
         log.info("Starting Smart Meter Scheduler...")
 
+        # Index thresholds and start the ingest writer before readings arrive
+        self.load_thresholds()
+        self.reading_filter.seed(self.db.get_devices())
+        self.ingest.start()
+        self.power_ingest.start()
+        self.device_ingest.start()
+        self.relay_tracker.start()
+        if self.shards:
+            self.shards.start()
+
+        THRESHOLDS_ACTIVE.set_function(lambda: len(self.thresholds))
+        JOBS_SCHEDULED.set_function(lambda: len(self.scheduler.get_jobs()))
+        self.scheduler.add_listener(self.record_job_event,
+                                    EVENT_JOB_SUBMITTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+
         # Connect MQTT
         self.mqtt.connect()
 
-        # Load and schedule all jobs from database
-        self.load_schedules()
+        # Load and schedule all jobs from database, catching up on
+        # transitions missed while the service was down
+        self.sync_schedules(recover=True)
 
-        # Start threshold monitoring (every 60 seconds)
+        # Thresholds are evaluated as readings are written; this low-frequency
+        # sweep only catches missed index updates and period rollovers
         self.scheduler.add_job(
             self.check_thresholds,
             'interval',
-            seconds=60,
+            minutes=15,
             id='threshold_monitor'
         )
 
+        # Rebuild yesterday's rollups from raw readings once it is closed
+        self.scheduler.add_job(
+            self.compact_rollups,
+            trigger=CronTrigger(hour=0, minute=15, timezone='UTC'),
+            id='rollup_compaction'
+        )
+
+        # Archive expired raw readings (incremental chunks)
+        self.scheduler.add_job(
+            self.retention.run,
+            trigger=CronTrigger(hour=0, minute=30, timezone='UTC'),
+            id='retention'
+        )
+
         # Start scheduler
         self.scheduler.start()
-        log.info("Scheduler started successfully")
 
-    def load_schedules(self):
-        """Load all enabled schedules from database"""
-        schedules = self.db.get_all_schedules(enabled=True)
+        # Accept hot-reload commands once jobs are in place
+        self.control.start()
+        log.info("Scheduler started successfully")
 
-        for schedule in schedules:
-            self.add_schedule_job(schedule)
+    def sync_schedules(self, recover=False):
+        """
+        Bring the jobs in line with the enabled schedules in the database,
+        only rebuilding schedules whose fingerprint changed. With recover,
+        daily transitions missed within MISFIRE_GRACE_SECONDS (e.g. during
+        a restart) are run now.
+        """
+        schedules = {s['id']: s for s in self.db.get_all_schedules(enabled=True)}
+        last_runs = self.db.get_last_executions() if recover else {}
+
+        removed = [schedule_id for schedule_id in self.job_fingerprints
+                   if schedule_id not in schedules]
+        for schedule_id in removed:
+            self.remove_schedule_jobs(schedule_id)
+
+        changed = 0
+        for schedule_id, schedule in schedules.items():
+            if self.job_fingerprints.get(schedule_id) != schedule_fingerprint(schedule):
+                self.remove_schedule_jobs(schedule_id)
+                self.add_schedule_job(schedule)
+                changed += 1
+            if recover and schedule['schedule_type'] == 'daily':
+                self.recover_missed_transition(schedule, last_runs)
+
+        log.info(f"Synced schedules: {changed} added/changed, {len(removed)} removed, "
+                 f"{len(schedules) - changed} unchanged")
+        return {'changed': changed, 'removed': len(removed),
+                'unchanged': len(schedules) - changed}
+
+    def recover_missed_transition(self, schedule, last_runs):
+        """Run the latest ON/OFF of a daily schedule that was due within the grace period but never logged"""
+        schedule_id = schedule['id']
+        now = datetime.now(timezone.utc)
+        missed = []
+
+        for action, job in self.dispatcher.transitions(schedule_id):
+            if not job:
+                continue
+            due = job.trigger.get_next_fire_time(None, now - timedelta(seconds=MISFIRE_GRACE_SECONDS))
+            last_run = last_runs.get((schedule_id, action))
+            if due and due <= now and (last_run is None or parse_utc(last_run) < due):
+                missed.append((due, action))
+
+        if missed:
+            due, action = max(missed)
+            func = self.turn_relay_on if action == 'ON' else self.turn_relay_off
+            log.info(f"Schedule {schedule_id}: {action} due at {due} was missed, running it now")
+            self.scheduler.add_job(func, args=[schedule['client_id'], schedule_id],
+                                   id=f'schedule_{schedule_id}_recover', replace_existing=True)
 
     def add_schedule_job(self, schedule):
         """Add a schedule to APScheduler"""
@@ -72,37 +283,23 @@ class SmartMeterScheduler:
             else:
                 days = None  # All days
 
-            # Schedule ON
-            self.scheduler.add_job(
-                self.turn_relay_on,
-                trigger=CronTrigger(
-                    hour=on_time.hour, 
-                    minute=on_time.minute,
-                    day_of_week=days
-                ),
-                args=[client_id, schedule_id],
-                id=f'schedule_{schedule_id}_on',
-                replace_existing=True
-            )
-
-            # Schedule OFF
-            self.scheduler.add_job(
-                self.turn_relay_off,
-                trigger=CronTrigger(
-                    hour=off_time.hour, 
-                    minute=off_time.minute,
-                    day_of_week=days
-                ),
-                args=[client_id, schedule_id],
-                id=f'schedule_{schedule_id}_off',
-                replace_existing=True
-            )
+            # ON and OFF join the dispatch groups for their trigger times
+            self.dispatcher.add(schedule_id, client_id, 'ON', on_time.hour, on_time.minute, days)
+            self.dispatcher.add(schedule_id, client_id, 'OFF', off_time.hour, off_time.minute, days)
 
             log.info(f"Added daily schedule for {client_id}: {on_time} - {off_time}, days: {days or 'all'}")
 
         elif schedule['schedule_type'] == 'timer':
-            # Timer: turn OFF after duration_seconds
-            run_time = datetime.now() + timedelta(seconds=schedule['duration_seconds'])
+            # Timer: turn OFF at its absolute fire time (set when created)
+            fire_at = parse_utc(schedule['fire_at'])
+            now = datetime.now(timezone.utc)
+
+            # Went off while the scheduler was down: turn off now, however late
+            run_time = max(fire_at, now)
+            if fire_at < now:
+                log.warning(f"Timer {schedule_id} for {client_id} is overdue by "
+                            f"{(now - fire_at).total_seconds():.0f}s, firing now")
+
             self.scheduler.add_job(
                 self.turn_relay_off,
                 trigger=DateTrigger(run_date=run_time),
@@ -111,80 +308,220 @@ class SmartMeterScheduler:
                 replace_existing=True
             )
 
-            log.info(f"Added timer for {client_id}: {schedule['duration_seconds']}s")
+            log.info(f"Added timer for {client_id}: fires at {schedule['fire_at']} UTC")
+
+        self.job_fingerprints[schedule_id] = schedule_fingerprint(schedule)
+
+    def reload_schedule(self, schedule_id):
+        """Replace the jobs of one schedule with its current database state"""
+        self.remove_schedule_jobs(schedule_id)
+
+        schedule = self.db.get_schedule(schedule_id)
+        if schedule and schedule['enabled']:
+            self.add_schedule_job(schedule)
+            return {'jobs': self.schedule_job_count(schedule_id)}
+
+        log.info(f"Schedule {schedule_id} is deleted or disabled, no jobs added")
+        return {'jobs': 0}
+
+    def remove_schedule_jobs(self, schedule_id):
+        """Remove a schedule's timer job and its transitions from the dispatch groups"""
+        removed = self.dispatcher.remove(schedule_id)
+        if self.scheduler.get_job(f'timer_{schedule_id}'):
+            self.scheduler.remove_job(f'timer_{schedule_id}')
+            removed += 1
+        self.job_fingerprints.pop(schedule_id, None)
+
+        if removed:
+            log.info(f"Removed {removed} job(s) of schedule {schedule_id}")
+        return {'removed': removed}
+
+    def schedule_job_count(self, schedule_id):
+        """Number of transitions (daily) or timer jobs scheduled for a schedule"""
+        return (len(self.dispatcher.transitions(schedule_id))
+                + bool(self.scheduler.get_job(f'timer_{schedule_id}')))
 
     def turn_relay_on(self, client_id, schedule_id):
         """Turn relay ON via MQTT"""
         log.info(f"Schedule {schedule_id}: Turning ON relay for {client_id}")
-        self.mqtt.publish_relay_command(client_id, 'RELAY_ON')
+        self.relay_tracker.send(client_id, 'RELAY_ON', 'schedule')
         self.db.log_schedule_execution(schedule_id, 'ON')
 
     def turn_relay_off(self, client_id, schedule_id):
         """Turn relay OFF via MQTT"""
         log.info(f"Schedule {schedule_id}: Turning OFF relay for {client_id}")
-        self.mqtt.publish_relay_command(client_id, 'RELAY_OFF')
+        self.relay_tracker.send(client_id, 'RELAY_OFF', 'schedule')
         self.db.log_schedule_execution(schedule_id, 'OFF')
 
         # If this was a timer, remove it from database
         schedule = self.db.get_schedule(schedule_id)
         if schedule and schedule['schedule_type'] == 'timer':
             self.db.delete_schedule(schedule_id)
+            self.job_fingerprints.pop(schedule_id, None)
 
     def handle_energy_reading(self, client_id, energy_kwh):
         """Handle incoming energy reading from ESP32"""
-        # Store reading in database
-        self.db.store_energy_reading(client_id, energy_kwh)
-
-    def check_thresholds(self):
-        """Check all active thresholds"""
-        thresholds = self.db.get_all_thresholds(enabled=True)
-
-        for threshold in thresholds:
-            client_id = threshold['client_id']
-            limit_kwh = threshold['limit_kwh']
-            reset_period = threshold['reset_period']
-
-            # Calculate consumption in current period
-            period_start = self.calculate_period_start(reset_period)
-            consumption = self.db.get_consumption_since(client_id, period_start)
-
-            if consumption >= limit_kwh:
-                log.warning(f"Threshold exceeded for {client_id}: {consumption:.2f}/{limit_kwh} kWh")
-
-                # Turn off relay
-                self.mqtt.publish_relay_command(client_id, 'RELAY_OFF')
-
-                # Publish alert
-                self.mqtt.publish_threshold_alert(client_id, consumption, limit_kwh)
+        if not self.reading_filter.accept(client_id, energy_kwh):
+            return
+
+        # Queue reading for the batch writer, stamped with arrival time
+        if not self.ingest.put((client_id, energy_kwh, utc_timestamp())):
+            # Not stored after all: let the next reading through
+            self.reading_filter.forget(client_id)
+
+    def handle_metrics(self, client_id, voltage, current, power):
+        """Handle incoming power metrics from ESP32"""
+        self.power_ingest.put((client_id, time.time(), voltage, current, power))
+
+    def handle_device_event(self, client_id, field, value, live):
+        """Handle status, heartbeat or relay state message from ESP32"""
+        if field == 'relay_state':
+            self.relay_tracker.observe_state(client_id, value, live)
+        self.device_ingest.put((client_id, field, value, utc_timestamp(), live))
+
+    def load_thresholds(self):
+        """Rebuild the in-memory threshold index from the database"""
+        # Read under the lock: a trip is either still in progress (skipped)
+        # or its disable is committed, never re-added in between
+        with self.thresholds_lock:
+            thresholds = [t for t in self.db.get_all_thresholds(enabled=True)
+                          if t['id'] not in self.thresholds_tripping]
+            self.thresholds = {t['client_id']: t for t in thresholds}
+        log.info(f"Loaded {len(thresholds)} active threshold(s)")
+
+    def reload_threshold(self, client_id):
+        """Refresh one device's threshold in the index (after an API change)"""
+        threshold = self.db.get_threshold(client_id)
+        with self.thresholds_lock:
+            if threshold and threshold['enabled']:
+                self.thresholds[client_id] = threshold
+            else:
+                self.thresholds.pop(client_id, None)
 
-                # Disable threshold to prevent repeated triggers
-                self.db.disable_threshold(threshold['id'])
+        # A new or lowered limit may already be exceeded
+        if threshold and threshold['enabled']:
+            self.evaluate_threshold(client_id)
+        return {'active': bool(threshold and threshold['enabled'])}
 
-    def calculate_period_start(self, reset_period):
-        """Calculate start of reset period"""
-        now = datetime.now()
+    def handle_readings_written(self, readings):
+        """Evaluate thresholds of devices that just had readings stored"""
+        self.check_devices({reading[0] for reading in readings})
 
-        if reset_period == 'daily':
-            return now.replace(hour=0, minute=0, second=0, microsecond=0)
-        elif reset_period == 'weekly':
-            days_since_monday = now.weekday()
-            return (now - timedelta(days=days_since_monday)).replace(
-                hour=0, minute=0, second=0, microsecond=0
-            )
-        elif reset_period == 'monthly':
-            return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    def check_devices(self, client_ids):
+        """Evaluate the thresholds of devices with new readings (also reported by shards)"""
+        with THRESHOLD_CHECK_SECONDS.time(trigger='ingest'):
+            for client_id in client_ids:
+                if client_id in self.thresholds:
+                    self.evaluate_threshold(client_id)
 
-        return now
+    def check_thresholds(self):
+        """Safety sweep: resync the threshold index and check every device"""
+        with THRESHOLD_CHECK_SECONDS.time(trigger='sweep'):
+            self.load_thresholds()
+
+            for client_id in list(self.thresholds):
+                self.evaluate_threshold(client_id)
+
+    def evaluate_threshold(self, client_id):
+        """Check one device's threshold and cut it off if exceeded"""
+        threshold = self.thresholds.get(client_id)
+        if not threshold:
+            return
+
+        # Consumption in current period (maintained on ingest)
+        consumption = self.db.get_period_consumption(client_id, threshold['reset_period'])
+        if self.trip_threshold(client_id, threshold, consumption):
+            # Disable threshold to prevent repeated triggers
+            self.disable_tripped(threshold)
+
+    def disable_tripped(self, threshold):
+        """Disable a tripped threshold in the database and end its trip"""
+        try:
+            self.db.disable_threshold(threshold['id'])
+        finally:
+            with self.thresholds_lock:
+                self.thresholds_tripping.discard(threshold['id'])
+
+    def trip_threshold(self, client_id, threshold, consumption):
+        """
+        Cut a device off if consumption reached its limit. Returns True if
+        this call claimed the trigger; the caller then calls disable_tripped.
+        """
+        limit_kwh = threshold['limit_kwh']
+        if consumption < limit_kwh:
+            return False
+
+        # Claim the trigger so a concurrent ingest flush or sweep can't repeat it
+        with self.thresholds_lock:
+            if self.thresholds.get(client_id) is not threshold:
+                return False
+            del self.thresholds[client_id]
+            # Until disable_tripped, a sweep must not load it again
+            self.thresholds_tripping.add(threshold['id'])
+
+        log.warning(f"Threshold exceeded for {client_id}: {consumption:.2f}/{limit_kwh} kWh")
+        THRESHOLDS_TRIGGERED.inc()
+
+        try:
+            # Turn off relay
+            self.relay_tracker.send(client_id, 'RELAY_OFF', 'threshold')
+
+            # Publish alert
+            self.mqtt.publish_threshold_alert(client_id, consumption, limit_kwh)
+        except Exception:
+            # Not disabled: the next sweep loads it and tries again
+            with self.thresholds_lock:
+                self.thresholds_tripping.discard(threshold['id'])
+            raise
+        return True
+
+    def record_job_event(self, event):
+        """APScheduler listener: submission lag, errors and misfires"""
+        kind = job_kind(event.job_id)
+        if event.code == EVENT_JOB_SUBMITTED:
+            now = datetime.now(timezone.utc)
+            for run_time in event.scheduled_run_times:
+                JOB_LAG_SECONDS.observe(max((now - run_time).total_seconds(), 0.0), job=kind)
+        elif event.code == EVENT_JOB_ERROR:
+            JOB_EVENTS.inc(job=kind, event='error')
+        else:
+            JOB_EVENTS.inc(job=kind, event='missed')
+
+    def compact_rollups(self):
+        """Rebuild the previous (closed) UTC day of rollups from raw readings"""
+        today = utc_now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.db.rebuild_rollups(since=today - timedelta(days=1), until=today)
 
     def shutdown(self, signum, frame):
-        """Graceful shutdown"""
+        """Graceful shutdown (signal handler)"""
+        self.stop()
+        sys.exit(0)
+
+    def stop(self):
+        """Stop all services, flushing queued data"""
         log.info("Shutting down scheduler...")
+        self.control.stop()
         self.scheduler.shutdown()
+        # Shards flush before MQTT goes down, so their last batches can
+        # still trip thresholds
+        if self.shards:
+            self.shards.stop()
+        self.relay_tracker.stop()
         self.mqtt.disconnect()
-        sys.exit(0)
+
+        # Flush readings still waiting in the ingest queue
+        self.ingest.stop()
+        self.power_ingest.stop()
+        self.device_ingest.stop()
+        self.db.close()
 
 if __name__ == '__main__':
-    service = SmartMeterScheduler()
+    parser = argparse.ArgumentParser(description="Smart meter scheduler service")
+    parser.add_argument('--shards', type=int, default=int(os.getenv('INGEST_SHARDS', '0')),
+                        help="ingest worker processes (0: ingest in this process)")
+    args = parser.parse_args()
+
+    service = SmartMeterScheduler(shards=args.shards)
 
     # Handle shutdown signals
     signal.signal(signal.SIGINT, service.shutdown)
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+from database import Database, utc_timestamp
+from ingest import IngestQueue
+from instrumentation import REGISTRY, counter, gauge, with_labels
+from mqtt_client import MQTTSchedulerClient
+from power_series import PowerSeriesStore
+from reading_filter import ReadingFilter
+
+log = logging.getLogger("shards")
+
+# Routed to the shards; relay state stays with the main process, whose
+# relay tracker needs every device's acknowledgements
+SHARD_TOPIC_SUFFIXES = ('/pzem/energy', '/pzem/metrics', '/status', '/heartbeat')
+
+# Seconds between a shard's stats/metrics reports to the supervisor
+REPORT_INTERVAL = 10
+
+# Routed messages are sent to a shard in batches of up to ROUTE_BATCH, at
+# least every ROUTE_INTERVAL seconds; a shard's inbox holds INBOX_BATCHES
+ROUTE_BATCH = 200
+ROUTE_INTERVAL = 0.05
+INBOX_BATCHES = 1000
+
+SHARD_RESTARTS = counter('smart_meter_shard_restarts_total', 'Ingest shard processes restarted after exiting')
+SHARDS_ALIVE = gauge('smart_meter_shards_alive', 'Ingest shard processes running')
+SHARD_ROUTED = counter('smart_meter_shard_routed_total',
+                       'Telemetry messages routed to ingest shards, by outcome', ['outcome'])
+
+def shard_of(client_id, shards):
+    """
+    Shard that owns a device. crc32 rather than hash(), which is salted
+    per process and would give every shard a different answer.
+    """
+    return zlib.crc32(client_id.encode()) % shards
+
+class IngestShard:
+    """
+    Ingest for the devices of one shard, run in its own process: parsing,
+    a reading filter and the energy/power/device ingest queues, writing
+    to the shared database. Messages arrive from the supervisor's router.
+    The client_ids of each stored energy batch are reported back so the
+    main process can check their thresholds.
+    """
+
+    def __init__(self, index, data_dir, events):
+        self.index = index
+        self.events = events
+
+        # The main process created and migrated the schema before spawning us
+        self.db = Database(f"{data_dir}/scheduler.db", init=False)
+
+        # Never connected: only its message parsing and callbacks are used
+        self.parser = MQTTSchedulerClient('localhost', 1883, client_id=f"scheduler-shard-{index}")
+        self.parser.on_energy_reading = self.handle_energy_reading
+        self.parser.on_metrics = self.handle_metrics
+        self.parser.on_device_event = self.handle_device_event
+
+        # Configured from the same environment as the main process
+        self.reading_filter = ReadingFilter(
+            tolerance_kwh=float(os.getenv('READING_TOLERANCE_KWH', '0')),
+            keepalive_seconds=int(os.getenv('READING_KEEPALIVE_SECONDS', '900'))
+        )
+
+        self.ingest = IngestQueue(
+            self.db.store_energy_readings,
+            name="energy-ingest",
+            on_written=self.report_written
+        )
+        self.power_series = PowerSeriesStore(self.db)
+        self.power_ingest = IngestQueue(
+            self.power_series.write_samples,
+            name="power-ingest",
+            batch_size=2000,
+            flush_interval=10.0
+        )
+        self.device_ingest = IngestQueue(
+            self.db.update_devices,
+            name="device-ingest",
+            flush_interval=5.0
+        )
+
+    def start(self, shards):
+        self.reading_filter.seed(device for device in self.db.get_devices()
+                                 if shard_of(device['client_id'], shards) == self.index)
+        self.ingest.start()
+        self.power_ingest.start()
+        self.device_ingest.start()
+
+    def stop(self):
+        self.ingest.stop()
+        self.power_ingest.stop()
+        self.device_ingest.stop()
+        self.report()
+        self.db.close()
+
+    def handle_batch(self, batch):
+        """Messages routed to this shard, in the order they were received"""
+        for topic, payload, retain in batch:
+            try:
+                self.parser.handle_message(topic, payload, retain)
+            except Exception as e:
+                log.error(f"Failed to handle message on {topic}: {e}")
+
+    def handle_energy_reading(self, client_id, energy_kwh):
+        if not self.reading_filter.accept(client_id, energy_kwh):
+            return
+        if not self.ingest.put((client_id, energy_kwh, utc_timestamp())):
+            self.reading_filter.forget(client_id)
+
+    def handle_metrics(self, client_id, voltage, current, power):
+        self.power_ingest.put((client_id, time.time(), voltage, current, power))
+
+    def handle_device_event(self, client_id, field, value, live):
+        self.device_ingest.put((client_id, field, value, utc_timestamp(), live))
+
+    def report_written(self, readings):
+        """Writer thread: hand the devices of a stored batch to the supervisor"""
+        self.events.put(('written', self.index, list({reading[0] for reading in readings})))
+
+    def report(self):
+        """Queue counters and this process's metrics, for shard_status and /metrics"""
+        self.events.put(('stats', self.index, {
+            'ingest': {ingest.name: ingest.stats()
+                       for ingest in (self.ingest, self.power_ingest, self.device_ingest)},
+            'reading_filter': self.reading_filter.stats(),
+            'families': REGISTRY.collect(),
+        }))
+
+def run_shard(index, shards, data_dir, inbox, events, log_level=logging.INFO):
+    """
+    Shard process entry point: handle routed batches until the supervisor
+    sends None, or until SIGTERM (then whatever is already queued is handled)
+    """
+    # force: importing the parent's main module (scheduler.py) already configured logging
+    logging.basicConfig(
+        level=log_level,
+        format=f'%(asctime)s - %(name)s[shard {index}] - %(levelname)s - %(message)s',
+        force=True
+    )
+    # Ctrl-C reaches the whole process group; the supervisor stops us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    terminated = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: terminated.set())
+
+    shard = IngestShard(index, data_dir, events)
+    shard.start(shards)
+    log.info(f"Shard {index}/{shards} started")
+
+    next_report = time.monotonic() + REPORT_INTERVAL
+    while True:
+        try:
+            batch = inbox.get(timeout=0 if terminated.is_set() else 1)
+        except queue.Empty:
+            if terminated.is_set():
+                break
+            batch = []
+        if batch is None:
+            break
+        shard.handle_batch(batch)
+
+        if time.monotonic() >= next_report:
+            shard.report()
+            next_report = time.monotonic() + REPORT_INTERVAL
+    shard.stop()
+
+class ShardSupervisor:
+    """
+    Runs energy, power and device-status ingest in `shards` worker
+    processes. The main process keeps the only MQTT connection: route()
+    is its router and hands each telemetry message, undecoded, to the
+    shard owning the device (shard_of), in batches over a per-shard
+    queue. A device is thus always handled by one process, in the order
+    the broker delivered its messages (MQTT shared subscriptions would
+    spread a device's readings over shards and break the per-device
+    filter and deltas; per-topic filters can't split on client_id).
+
+    Dead shards are restarted every check_interval seconds. Written
+    batches and periodic stats come back on one queue, read by a thread
+    that calls on_written(client_ids).
+    """
+
+    def __init__(self, shards, data_dir, on_written, check_interval=5.0, log_level=logging.INFO):
+        self.shards = shards
+        self.data_dir = data_dir
+        self.on_written = on_written
+        self.check_interval = check_interval
+        # Log level of the shard processes (set before start)
+        self.log_level = log_level
+
+        # spawn, not fork: the main process already runs threads and holds
+        # SQLite connections that must not be copied into the children
+        self._context = multiprocessing.get_context('spawn')
+        self.events = self._context.Queue()
+        self._inboxes = [None] * shards
+        self._buffers = [[] for _ in range(shards)]
+        self._buffer_lock = threading.Lock()
+
+        self._processes = [None] * shards
+        self._started_at = [None] * shards
+        self._restarts = [0] * shards
+        # index -> latest stats report
+        self._reports = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+        SHARDS_ALIVE.set_function(lambda: sum(1 for p in self._processes if p and p.is_alive()))
+
+    def start(self):
+        """Spawn all shards and the monitor/router/receiver threads"""
+        self._stop.clear()
+        for index in range(self.shards):
+            self._spawn(index)
+        self._threads = [
+            threading.Thread(target=self._monitor, name="shard-monitor", daemon=True),
+            threading.Thread(target=self._flush_loop, name="shard-router", daemon=True),
+        ]
+        self._receiver = threading.Thread(target=self._receive, name="shard-receiver", daemon=True)
+        for thread in self._threads + [self._receiver]:
+            thread.start()
+        log.info(f"Started {self.shards} ingest shard(s)")
+
+    def stop(self, timeout=15):
+        """
+        Send every shard what is still buffered and then None, wait for
+        them to flush and exit, and only then stop the receiver, so the
+        written events of their last batches are still handled
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(5)
+        self._threads = []
+        self._flush()
+
+        for index, inbox in enumerate(self._inboxes):
+            try:
+                inbox.put(None, timeout=timeout)
+            except queue.Full:
+                log.warning(f"Shard {index} inbox is full, terminating it")
+                self._processes[index].terminate()
+
+        for index, process in enumerate(self._processes):
+            process.join(timeout)
+            if process.is_alive():
+                log.warning(f"Shard {index} did not stop within {timeout}s, killing it")
+                process.kill()
+                process.join()
+
+        # Every shard has exited, so its events are all queued before this
+        self.events.put(('stopped', None, None))
+        self._receiver.join(timeout)
+
+    def route(self, topic, payload, retain):
+        """MQTT thread (router): queue a telemetry message for its device's shard"""
+        if not topic.endswith(SHARD_TOPIC_SUFFIXES):
+            return False
+
+        index = shard_of(topic.split('/')[1], self.shards)
+        with self._buffer_lock:
+            buffer = self._buffers[index]
+            buffer.append((topic, payload, retain))
+            if len(buffer) < ROUTE_BATCH:
+                return True
+            self._buffers[index] = []
+        self._send(index, buffer)
+        return True
+
+    def _send(self, index, batch):
+        # Under the lock _spawn swaps inboxes with, so a batch routed
+        # after a restart never goes to the dead process's inbox
+        with self._buffer_lock:
+            try:
+                self._inboxes[index].put_nowait(batch)
+                SHARD_ROUTED.inc(len(batch), outcome='sent')
+            except queue.Full:
+                SHARD_ROUTED.inc(len(batch), outcome='dropped')
+                log.warning(f"Shard {index} is not keeping up, dropped {len(batch)} message(s)")
+
+    def _flush(self):
+        """Send every non-empty buffer"""
+        with self._buffer_lock:
+            pending = [(index, buffer) for index, buffer in enumerate(self._buffers) if buffer]
+            for index, _ in pending:
+                self._buffers[index] = []
+        for index, buffer in pending:
+            self._send(index, buffer)
+
+    def _flush_loop(self):
+        """Bound the latency of partly filled batches on a quiet fleet"""
+        while not self._stop.wait(ROUTE_INTERVAL):
+            self._flush()
+
+    def _spawn(self, index):
+        # A fresh inbox: a process killed while reading (or waiting to
+        # read) leaves the old queue's lock held, so it can't be drained.
+        # Whatever it still contained is lost.
+        inbox = self._context.Queue(maxsize=INBOX_BATCHES)
+        process = self._context.Process(
+            target=run_shard,
+            args=(index, self.shards, self.data_dir, inbox, self.events, self.log_level),
+            name=f"ingest-shard-{index}",
+            daemon=True
+        )
+        process.start()
+        with self._buffer_lock:
+            old, self._inboxes[index] = self._inboxes[index], inbox
+        if old:
+            # Nobody reads it any more: don't wait to flush it on exit
+            old.cancel_join_thread()
+            old.close()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+
+    def _monitor(self):
+        """Restart shards that exited"""
+        while not self._stop.wait(self.check_interval):
+            for index, process in enumerate(self._processes):
+                if process.is_alive() or self._stop.is_set():
+                    continue
+                log.error(f"Shard {index} (pid {process.pid}) exited with code "
+                          f"{process.exitcode}, restarting")
+                SHARD_RESTARTS.inc()
+                self._restarts[index] += 1
+                self._spawn(index)
+
+    def _receive(self):
+        """Dispatch written batches and keep the latest stats of each shard, until stop()"""
+        while True:
+            kind, index, payload = self.events.get()
+
+            if kind == 'stopped':
+                return
+            if kind == 'written':
+                try:
+                    self.on_written(payload)
+                except Exception as e:
+                    log.error(f"Post-write handler for shard {index} failed: {e}")
+            elif kind == 'stats':
+                with self._lock:
+                    self._reports[index] = dict(payload, reported_at=utc_timestamp())
+
+    def families(self):
+        """Latest reported metrics of every shard, labelled with its index"""
+        with self._lock:
+            reports = dict(self._reports)
+        families = []
+        for index, report in sorted(reports.items()):
+            families.extend(with_labels(report['families'], shard=str(index)))
+        return families
+
+    def status(self):
+        """Process state and latest reported counters of each shard"""
+        now = time.monotonic()
+        with self._lock:
+            reports = dict(self._reports)
+
+        shards = []
+        for index, process in enumerate(self._processes):
+            report = reports.get(index, {})
+            alive = bool(process and process.is_alive())
+            shards.append({
+                'shard': index,
+                'pid': process.pid if process else None,
+                'alive': alive,
+                'restarts': self._restarts[index],
+                'uptime_seconds': round(now - self._started_at[index], 1) if alive else None,
+                'reported_at': report.get('reported_at'),
+                'ingest': report.get('ingest'),
+                'reading_filter': report.get('reading_filter'),
+            })
+        return {'shards': shards}
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+# api.py derives its paths from $HOME at import time
+HOME = tempfile.mkdtemp(prefix="test-api-")
+os.environ['HOME'] = HOME
+os.makedirs(f"{HOME}/smart_meter", exist_ok=True)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api
+
+@pytest.fixture(scope='module')
+def client():
+    api.db.store_energy_readings([('ESP32-0001', i / 10, f"2026-01-01 00:{i:02d}:00")
+                                  for i in range(5)])
+    return api.app.test_client()
+
+@pytest.mark.parametrize('page_size', ['0', '-1', str(api.MAX_PAGE_SIZE + 1)])
+def test_range_page_size_out_of_bounds(client, page_size):
+    response = client.get(f'/api/energy/ESP32-0001/range?page_size={page_size}')
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+def test_range_page_size_default(client):
+    response = client.get('/api/energy/ESP32-0001/range?cursor=')
+    assert response.status_code == 200
+    assert len(response.get_json()['readings']) == 5
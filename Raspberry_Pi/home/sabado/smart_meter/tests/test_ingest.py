@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import ingest
+from database import Database
+from ingest import IngestQueue
+
+@pytest.fixture
+def short_waits(monkeypatch):
+    # Give up on the lock after 50 ms and retry quickly
+    monkeypatch.setattr(database, 'BUSY_TIMEOUT_MS', 50)
+    monkeypatch.setattr(ingest, 'LOCK_BACKOFF', 0.05)
+
+def hold_write_lock(db, seconds, locked):
+    """Another writer: keep a write transaction open for seconds"""
+    with db.get_connection() as conn:
+        conn.execute("INSERT INTO devices (client_id, first_seen) VALUES ('ESP32-other', '2026-01-01 00:00:00')")
+        locked.set()
+        time.sleep(seconds)
+
+def test_batch_retried_while_another_writer_holds_the_lock(tmp_path, short_waits):
+    path = str(tmp_path / 'scheduler.db')
+    db, other = Database(path), Database(path, init=False)
+
+    locked = threading.Event()
+    holder = threading.Thread(target=hold_write_lock, args=(other, 0.3, locked))
+    holder.start()
+    locked.wait(5)
+
+    queue = IngestQueue(db.store_energy_readings, name='test-ingest')
+    readings = [(f"ESP32-{i:04d}", 1.0, '2026-01-01 00:00:00') for i in range(10)]
+    queue._flush(readings)
+    holder.join()
+
+    assert queue.retried > 0
+    assert queue.written == 10 and queue.failed == 0
+    with db.read_connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM energy_readings').fetchone()[0] == 10
+    db.close()
+    other.close()
+
+def test_batch_failed_once_retries_run_out(tmp_path, short_waits, monkeypatch):
+    monkeypatch.setattr(ingest, 'LOCK_RETRIES', 1)
+    path = str(tmp_path / 'scheduler.db')
+    db, other = Database(path), Database(path, init=False)
+
+    locked = threading.Event()
+    holder = threading.Thread(target=hold_write_lock, args=(other, 1.0, locked))
+    holder.start()
+    locked.wait(5)
+
+    queue = IngestQueue(db.store_energy_readings, name='test-ingest')
+    queue._flush([('ESP32-0000', 1.0, '2026-01-01 00:00:00')])
+    holder.join()
+
+    assert queue.retried == 1
+    assert queue.written == 0 and queue.failed == 1
+    db.close()
+    other.close()
+
+def test_other_errors_are_not_retried():
+    def write_batch(batch):
+        raise sqlite3.IntegrityError('constraint failed')
+
+    queue = IngestQueue(write_batch, name='test-ingest')
+    queue._flush([1, 2])
+    assert queue.retried == 0 and queue.failed == 2
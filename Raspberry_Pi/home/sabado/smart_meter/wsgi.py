@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+"""
+WSGI entry point for the REST API:
+
+    gunicorn --config gunicorn.conf.py wsgi:app
+
+`python3 api.py` still runs Flask's built-in server for development.
+"""
+
+from api import app